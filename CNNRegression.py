@@ -1,13 +1,14 @@
 # fit 16D data to 1D data with ROOT
 
 import ROOT
-import os
 import numpy as np
 from scipy.stats import norm
 from modules.fitFunction import fitFunction
-from modules.utils import getChannelMap, parseRuns
-from modules.CNNModel import buildCNNModel
-from modules.runinfo import GetRegressionGoal
+from modules.utils import parseRuns
+from modules.dataLoader import loadRunChannels, iterRunChannels, clearDataFrames, getRunChannelsFile
+from modules.geometry import toGrid, fromGrid, geometry
+from modules.CNNModel import buildCNNModel, exportCNNWeights
+from modules.runinfo import GetRegressionGoal, CheckRunExists
 import tensorflow as tf
 from tensorflow.keras.callbacks import ModelCheckpoint, EarlyStopping, ReduceLROnPlateau
 
@@ -15,27 +16,94 @@ from tensorflow.keras.callbacks import ModelCheckpoint, EarlyStopping, ReduceLRO
 ROOT.gROOT.SetBatch(True)
 
 
-def RunCNNRegression(run_start, run_end):
-    t = ROOT.TChain("save")
-    for run in range(run_start, run_end):
-        fname = f"root_selected/Run{run}_list_selected.root"
-        if not os.path.exists(fname):
-            print(f"File {fname} does not exist")
+def makeDataset(runs, batchsize=1024, shuffle=100000, chunksize=65536):
+    """
+    tf.data pipeline of the selected events of the runs, read in chunks from
+    several runs in parallel, with the regression goal of each run as target,
+    shuffled, batched and prefetched. The events are streamed at every epoch
+    instead of being held in memory.
+    The tf.data threads only read memory-mapped .npy files of the runs, written
+    beforehand from the ROOT files, such that no ROOT event loop runs in them
+    """
+    if len(runs) == 0:
+        raise ValueError("No runs to train on")
+    ROOT.EnableThreadSafety()
+    nx, ny = geometry["nx"], geometry["ny"]
+
+    fnames, targets = [], []
+    for run in runs:
+        fname = getRunChannelsFile(run, selected=True)
+        if fname is None:
             continue
-        t.Add(fname)
-
-    nentries = t.GetEntries()
-    print(f"Number of entries: {nentries}")
-
-    chans = np.zeros((nentries, 4, 4, 1), dtype=np.float32)
-
-    for i in range(nentries):
-        t.GetEntry(i)
-        for j in range(16):
-            x, y = getChannelMap(j)
-            chans[i][x][y][0] = t.ch_lg[j]
-
-    def trainCNNModel(chans, energys):
+        fnames.append(fname)
+        targets.append(GetRegressionGoal(run))
+    if len(fnames) == 0:
+        raise ValueError(f"No files for the runs {runs}")
+
+    def generator(fname, target):
+        chans = np.load(fname.decode(), mmap_mode="r")
+        for start in range(0, chans.shape[0], chunksize):
+            yield toGrid(np.asarray(chans[start:start+chunksize], dtype=np.float32)), target
+
+    spec = (tf.TensorSpec(shape=(None, nx, ny, 1), dtype=tf.float32),
+            tf.TensorSpec(shape=(), dtype=tf.float32))
+
+    def readRun(fname, target):
+        return tf.data.Dataset.from_generator(generator, output_signature=spec, args=(fname, target))
+
+    def addEnergys(chans, target):
+        energys = tf.random.normal(tf.shape(chans)[:1], target, target * 0.01)
+        return chans, energys
+
+    ds = tf.data.Dataset.from_tensor_slices(
+        (fnames, np.array(targets, dtype=np.float32)))
+    ds = ds.interleave(readRun, cycle_length=min(len(fnames), 8),
+                       num_parallel_calls=tf.data.AUTOTUNE, deterministic=False)
+    ds = ds.map(addEnergys, num_parallel_calls=tf.data.AUTOTUNE)
+    ds = ds.unbatch().shuffle(shuffle).batch(batchsize)
+    return ds.prefetch(tf.data.AUTOTUNE)
+
+
+def getTrainingRuns(run_start, run_end, runs=None):
+    """
+    runs with a regression goal, from run_start to run_end or from the list runs
+    """
+    if runs is None:
+        runs = range(run_start, run_end)
+    selected = []
+    for run in runs:
+        if not CheckRunExists(run):
+            print(f"Run {run} does not exist")
+            continue
+        if GetRegressionGoal(run) is None:
+            continue
+        selected.append(run)
+    return selected
+
+
+def parseRunList(runlist):
+    """
+    "496-507,585-589" to the list of runs, the end of each range excluded as in --end
+    """
+    runs = []
+    for item in runlist.split(","):
+        if "-" in item:
+            start, end = item.split("-")
+            runs += list(range(int(start), int(end)))
+        else:
+            runs.append(int(item))
+    return runs
+
+
+def RunCNNRegression(run_start, run_end, stream=False, runs=None, batchsize=32, shuffle=100000):
+    """
+    with stream, the events are fed to the training with a tf.data pipeline
+    instead of a numpy array in memory, and runs can be a list of runs
+    of different samples, each with its own regression goal
+    """
+    checkpointname = f'results/best_model_Run{run_start}_Run{run_end}.keras'
+
+    def trainCNNModel(chans, energys=None):
         model = buildCNNModel()
         model.summary()
         # Compile the model with a custom learning rate
@@ -45,31 +113,60 @@ def RunCNNRegression(run_start, run_end):
         model.compile(optimizer=optimizer, loss='mean_absolute_error')
 
         checkpoint = ModelCheckpoint(
-            f'results/best_model_Run{run_start}_Run{run_end}.keras', monitor='loss', save_best_only=True, mode='min')
+            checkpointname, monitor='loss', save_best_only=True, mode='min')
         early_stopping = EarlyStopping(
             monitor='loss', patience=5, mode='min', verbose=1)
         lr_scheduler = ReduceLROnPlateau(
             monitor='loss', factor=0.5, patience=3, min_lr=1e-6, verbose=1)
-        model.fit(chans, energys, epochs=20, batch_size=32,
-                  callbacks=[checkpoint, early_stopping, lr_scheduler])
+        if energys is None:
+            # tf.data pipeline, already batched
+            model.fit(chans, epochs=20,
+                      callbacks=[checkpoint, early_stopping, lr_scheduler])
+        else:
+            model.fit(chans, energys, epochs=20, batch_size=batchsize,
+                      callbacks=[checkpoint, early_stopping, lr_scheduler])
         return model
 
     # target = 3100.0 * 0.3
     target = GetRegressionGoal(run_start)
     print(f"Regression goal: {target}")
-    energys = np.random.normal(target, target * 0.01, nentries)
-    result = trainCNNModel(chans, energys)
 
-    # predictions = fitFunction(chans, result.x)
-    predictions = result.predict(chans)
+    if stream:
+        runs = getTrainingRuns(run_start, run_end, runs)
+        print(f"Training on runs {runs}")
+        result = trainCNNModel(makeDataset(runs, batchsize, shuffle))
+    else:
+        chans = toGrid(loadRunChannels(
+            range(run_start, run_end), selected=True))
+        nentries = chans.shape[0]
+        print(f"Number of entries: {nentries}")
+        energys = np.random.normal(target, target * 0.01, nentries)
+        result = trainCNNModel(chans, energys)
+    # weights of the best model for the numpy inference in applyCorrection
+    exportCNNWeights(checkpointname, checkpointname.replace(".keras", ".npz"))
+
+    if stream:
+        # evaluate the runs chunk by chunk
+        predictions, predictions_unc = [], []
+        for chans in iterRunChannels(runs, selected=True):
+            predictions.append(result.predict(toGrid(chans), batch_size=65536))
+            predictions_unc.append(fitFunction(chans, np.ones(17)))
+        predictions = np.concatenate(predictions)
+        predictions_unc = np.concatenate(predictions_unc)
+        clearDataFrames()
+        nentries = predictions.shape[0]
+    else:
+        # predictions = fitFunction(chans, result.x)
+        predictions = result.predict(chans)
     print("predictions after trainng: ", predictions)
     mu, std = norm.fit(predictions)
     print(f"mu = {mu}, std = {std}, relative std = {std/mu}")
     predictions = predictions.astype(np.float64)
 
     # sum
-    chans = chans.reshape(nentries, 16)
-    predictions_unc = fitFunction(chans, np.ones(17))
+    if not stream:
+        chans = fromGrid(chans)
+        predictions_unc = fitFunction(chans, np.ones(17))
     mu_unc, std_unc = norm.fit(predictions_unc)
     print(
         f"mu_unc = {mu_unc}, std_unc = {std_unc}, relative std = {std_unc/mu_unc}")
@@ -89,5 +186,18 @@ def RunCNNRegression(run_start, run_end):
 
 
 if __name__ == "__main__":
+    import argparse
     run_start, run_end = parseRuns()
-    RunCNNRegression(run_start, run_end)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stream", action="store_true",
+                        help="stream the events to the training with tf.data instead of loading them in memory")
+    parser.add_argument("--runs", type=str, default=None,
+                        help="runs to train on in stream mode, e.g. 496-507,585-589, default is --start to --end")
+    parser.add_argument("--batchsize", type=int, default=32,
+                        help="training batch size")
+    parser.add_argument("--shuffle", type=int, default=100000,
+                        help="number of events in the shuffle buffer in stream mode")
+    args, unknown = parser.parse_known_args()
+    runs = parseRunList(args.runs) if args.runs is not None else None
+    RunCNNRegression(run_start, run_end, stream=args.stream, runs=runs,
+                     batchsize=args.batchsize, shuffle=args.shuffle)
@@ -2,17 +2,51 @@
 
 import ROOT
 import os
-import numpy as np
-from modules.fitFunction import saveResults, runFit, runMIPFit
+from modules.fitFunction import saveResults, runFitOnly, drawFit, getHistData, makeHist, runSimultaneousMIPFit
 from modules.runinfo import IsMuonRun, GetTitle, GetMIPFitRange
-from modules.utils import plotCh1D, plotChMap, getChannelMap, plotCh2D, parseRuns
+from modules.utils import plotChMap, getChannelMap, parseRuns, getRunDataFrame, bookCh1D, drawCh1D, bookCh2D, drawCh2D
 from modules.plotStyles import DrawHistos
 from collections import OrderedDict
+from multiprocessing import Pool
 
 ROOT.gROOT.SetBatch(True)
 
 
-def RunMuonCalibration(start, end):
+def fitChannel(job):
+    """
+    MIP fit of one channel, from the detached bin contents of its histogram
+    """
+    h = makeHist(job["hist"], "hmip_" + job["suffix"])
+    result = runFitOnly(h, job["suffix"], "mip", **job["fitargs"])
+    drawFit(result, job["outdir"])
+    return result
+
+
+def fitChannels(histos, start, end, xmin, xmax, xfitmin, xfitmax, njobs=16):
+    """
+    MIP fits of the channels in a pool of njobs processes.
+    The workers get the bin contents of the histograms instead of the ROOT objects.
+    Returns the fit results of the channels, in the order of histos
+    """
+    jobs = []
+    for ch, h in enumerate(histos):
+        jobs.append({
+            "suffix": f"cal_Run{start}_Run{end}_{ch}",
+            "hist": getHistData(h),
+            "fitargs": {"xmin": xmin, "xmax": xmax, "xfitmin": xfitmin, "xfitmax": xfitmax},
+            "outdir": "plots/MIPCalib",
+        })
+    if njobs > 1:
+        with Pool(njobs) as p:
+            return p.map(fitChannel, jobs, chunksize=1)
+    return [fitChannel(job) for job in jobs]
+
+
+def RunMuonCalibration(start, end, njobs=16, simultaneous=False):
+    """
+    with simultaneous, the 16 channels are fitted together with shared tail shapes,
+    with the likelihood evaluated on njobs processes, instead of 16 independent fits
+    """
     t = ROOT.TChain("save")
     for run in range(start, end+1):
         fname = f"root/Run{run}_list.root"
@@ -32,20 +66,31 @@ def RunMuonCalibration(start, end):
 
     xmin, xmax, xfitmin, xfitmax = GetMIPFitRange(start)
 
-    histos_hg, _ = plotCh1D(t, run, plotAvg=False, applySel=False,
-                            makePlots=False, xmin=xmin, xmax=xmax, xbins=50)
-    plotCh2D(t, run, plotAvg=True, applySel=False,
-             outdir="plots/MIPCalib/Ch2D")
+    # the 1D and 2D histograms are filled in one event loop
+    rdf = getRunDataFrame(t)
+    h1D = bookCh1D(rdf, run, applySel=False, xmin=xmin, xmax=xmax, xbins=50)
+    h2D = bookCh2D(rdf, run, applySel=False)
+    histos_hg, _ = drawCh1D(h1D, run, plotAvg=False,
+                            makePlots=False, xmin=xmin, xmax=xmax)
+    drawCh2D(h2D, run, plotAvg=True, outdir="plots/MIPCalib/Ch2D")
 
     means = OrderedDict()
     sigmas = OrderedDict()
 
     print(f"Fit range: {xmin} {xmax} {xfitmin} {xfitmax}")
-    for ch in range(16):
-        (mean, mean_err), (sigma, sigma_err) = runMIPFit(histos_hg[ch], f"cal_Run{start}_Run{end}_{ch}",
-                                                         xmin=xmin, xmax=xmax, xfitmin=xfitmin, xfitmax=xfitmax, outdir="plots/MIPCalib")
-        means[ch] = (mean, mean_err)
-        sigmas[ch] = (sigma, sigma_err)
+    if simultaneous:
+        fits = runSimultaneousMIPFit([histos_hg[ch] for ch in range(16)], f"cal_Run{start}_Run{end}",
+                                     xmin=xmin, xmax=xmax, xfitmin=xfitmin, xfitmax=xfitmax, ncpu=njobs)
+        for fit in fits:
+            drawFit(fit, "plots/MIPCalib")
+    else:
+        fits = fitChannels([histos_hg[ch] for ch in range(16)], start, end,
+                           xmin, xmax, xfitmin, xfitmax, njobs)
+    for ch, fit in enumerate(fits):
+        if fit["status"] != 0:
+            print(f"Warning: fit of channel {ch} has status {fit['status']}")
+        means[ch] = (fit["values"]["mean"], fit["errors"]["mean"])
+        sigmas[ch] = (fit["values"]["sigma"], fit["errors"]["sigma"])
 
     baseChan = 12
     baseMean = means[baseChan][0]
@@ -99,5 +144,12 @@ def RunMuonCalibration(start, end):
 
 
 if __name__ == "__main__":
+    import argparse
     run_start, run_end = parseRuns()
-    RunMuonCalibration(run_start, run_end)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-j", "--jobs", type=int, default=16,
+                        help="number of channel fits run in parallel, or of processes of the simultaneous fit")
+    parser.add_argument("--simultaneous", action="store_true",
+                        help="fit all the channels together, with shared tail shape parameters")
+    args, unknown = parser.parse_known_args()
+    RunMuonCalibration(run_start, run_end, args.jobs, args.simultaneous)
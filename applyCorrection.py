@@ -1,14 +1,32 @@
 import numpy as np
 import ROOT
 import os
-from modules.CNNModel import loadCNNModel
+import time
+import multiprocessing
+from modules.CNNNumpy import NumpyCNNModel
 from modules.fitFunction import fitFunction, loadResults
-from modules.utils import getChannelMap
-from modules.runinfo import runinfo, GetFitRange, GetRunInfo, CheckRunExists
-
-
-def applyCNNRegression(model, chans, run, verbose=False, applyCutForWeightPlots=True):
-    predictions, weights = model.predict(chans)
+from modules.dataLoader import loadRunChannels
+from modules.geometry import toGrid, fromGrid
+from modules.runinfo import GetFitRange, GetRunInfo, CheckRunExists
+from modules.manifest import isUpToDate, recordManifest, parseForce
+from modules.runCache import hasRunCache, isRunCacheStale, getCachePath
+from modules import fitFunction as _fitFunction, CNNNumpy as _CNNNumpy, geometry as _geometry, \
+    dataLoader as _dataLoader, runCache as _runCache
+
+# source files of this stage, for the manifests.
+# CNNModel is given by path, importing it would import tensorflow
+code = [__file__, _fitFunction.__file__, _CNNNumpy.__file__, _geometry.__file__,
+        _dataLoader.__file__, _runCache.__file__,
+        os.path.join(os.path.dirname(_geometry.__file__), "CNNModel.py")]
+
+
+def applyCNNRegression(model, chans, run, verbose=False, applyCutForWeightPlots=True, outputs=None):
+    """
+    outputs are the (predictions, weights) of the model on chans if already computed
+    """
+    if outputs is None:
+        outputs = model.predict(chans)
+    predictions, weights = outputs
     predictions = predictions.astype(np.float64)
 
     raw = np.sum(chans, axis=(1, 2, 3))
@@ -49,39 +67,54 @@ def applyLinearRegression(chans, scales, verbose=False):
     return predictions
 
 
-def Evaluate(run, model=None, scales=None, mipcalibs=None, verbose=False):
+def getOutput(run, model=None, scales=None, mipcalibs=None, calibfiles=[]):
+    """
+    output file, inputs and parameters of the manifest of a run
+    """
+    outname = f"calibrated/Run{run}_list.root"
     fname = f"root/Run{run}_list.root"
-    if not os.path.exists(fname):
-        print(f"File {fname} does not exist")
-        return
+    inputs = [f for f in [fname] + calibfiles if os.path.exists(f)]
+    # the channels are read from the cache instead of the ROOT file when it is valid
+    if hasRunCache(run) and not isRunCacheStale(run, fname):
+        inputs.append(getCachePath(run, "ch_lg"))
+    params = {"cnn": model is not None, "linear": scales is not None,
+              "mip": mipcalibs is not None}
+    return outname, inputs, params
+
+
+def Evaluate(run, model=None, scales=None, mipcalibs=None, verbose=False, calibfiles=[], force=False,
+             chans=None, cnnoutputs=None):
+    """
+    apply the calibrations to one run and save the energy histograms.
+    calibfiles are the calibration files model, scales and mipcalibs were loaded from.
+    The run is skipped if neither the run nor the calibration files have changed, unless force is True.
+    chans and cnnoutputs are the channels of the run and the CNN outputs, if already computed.
+    Returns the number of events evaluated, 0 if skipped.
+    """
+    outname, inputs, params = getOutput(
+        run, model, scales, mipcalibs, calibfiles)
+    if not force and isUpToDate(outname, inputs, params, code):
+        print(f"Run {run} is up to date, skipping")
+        return 0
 
     print("Evaluating Run ", run)
-    f = ROOT.TFile(fname)
-    t = f.Get("save")
-    nentries = t.GetEntries()
+    if chans is None:
+        chans = toGrid(loadRunChannels([run]))
+    nentries = chans.shape[0]
     print(f"Number of entries: {nentries}")
 
     if nentries == 0:
-        f.Close()
-        print("No entries in the file ", fname)
-        return
-
-    chans = np.zeros((nentries, 4, 4, 1), dtype=np.float32)
-
-    for i in range(nentries):
-        t.GetEntry(i)
-        for j in range(16):
-            x, y = getChannelMap(j)
-            chans[i][x][y][0] = t.ch_lg[j]
+        print(f"No entries in Run {run}")
+        return 0
 
-    if not os.path.exists("calibrated"):
-        os.makedirs("calibrated")
-    ofile = ROOT.TFile(f"calibrated/Run{run}_list.root", "RECREATE")
+    os.makedirs("calibrated", exist_ok=True)
+    # write to a temporary file, such that an interrupted run never leaves a partial output
+    ofile = ROOT.TFile(outname + ".part", "RECREATE")
 
     if model:
         print("Applying CNN Regression")
         predictions, weights_avg, weights_std = applyCNNRegression(
-            model, chans, run, verbose)
+            model, chans, run, verbose, outputs=cnnoutputs)
 
         hweights = ROOT.TH2F("hweights", "Weights", 4, -0.5, 3.5, 4, -0.5, 3.5)
         for i in range(4):
@@ -94,7 +127,8 @@ def Evaluate(run, model=None, scales=None, mipcalibs=None, verbose=False):
         hcal.FillN(nentries, predictions, np.ones(nentries))
         hcal.Write()
 
-    chans = chans.reshape(nentries, 16)
+    # back to the channel order of the calibration constants
+    chans = fromGrid(chans)
     if type(scales) is np.ndarray:
         print("Applying Linear Regression")
         predictions_linear = applyLinearRegression(chans, scales, verbose)
@@ -120,6 +154,139 @@ def Evaluate(run, model=None, scales=None, mipcalibs=None, verbose=False):
     hcal_unc.Write()
 
     ofile.Close()
+    os.replace(outname + ".part", outname)
+    recordManifest(outname, inputs, params, code)
+    return nentries
+
+
+def loadCalibrations(file_mipcalib="", file_linear="", file_cnn=""):
+    """
+    load the CNN model, the linear regression and the MIP calibration scales
+    from their files, None for the ones not given
+    """
+    mipcalibs = None
+    if file_mipcalib != "":
+        print(f"Using MIP calibration file: {file_mipcalib}")
+        mipcalibs = loadResults(file_mipcalib)
+        # linear regression has a bias term but not used.
+        # add a dummy value for the bias term, only place holder, not used
+        mipcalibs.append(1.0)
+        mipcalibs = np.array(mipcalibs)
+
+    linearcalibs = None
+    if file_linear != "":
+        print(f"Using Linear regression file: {file_linear}")
+        linearcalibs = loadResults(file_linear)
+        linearcalibs = np.array(linearcalibs)
+
+    cnnmodel = None
+    if file_cnn.endswith(".npz"):
+        # weights exported with exportCNNModel.py, no tensorflow needed
+        print(f"Using CNN weights file: {file_cnn}")
+        cnnmodel = NumpyCNNModel(file_cnn)
+    elif file_cnn != "":
+        print(f"Using CNN model file: {file_cnn}")
+        from modules.CNNModel import loadCNNModel
+        cnnmodel = loadCNNModel(file_cnn)
+
+    return cnnmodel, linearcalibs, mipcalibs
+
+
+# calibrations of the worker processes, loaded once per worker by initWorker
+_worker = {}
+
+
+def initWorker(calibfiles, force):
+    ROOT.gROOT.SetBatch(True)
+    _worker["calibs"] = loadCalibrations(*calibfiles)
+    _worker["calibfiles"] = [fname for fname in calibfiles if fname != ""]
+    _worker["force"] = force
+
+
+def evaluateWorker(run):
+    model, scales, mipcalibs = _worker["calibs"]
+    start = time.time()
+    nentries = Evaluate(run, model, scales, mipcalibs,
+                        calibfiles=_worker["calibfiles"], force=_worker["force"])
+    return run, nentries, time.time() - start
+
+
+def EvaluateRuns(runs, calibfiles, force=False, njobs=4):
+    """
+    apply the calibrations to the runs in a pool of njobs processes,
+    each loading the calibrations once. calibfiles are the (mip, linear, cnn) files,
+    "" for the ones not used
+    """
+    start = time.time()
+    ntotal = 0
+    if njobs > 1:
+        # spawn instead of fork, as tensorflow does not survive a fork
+        ctx = multiprocessing.get_context("spawn")
+        with ctx.Pool(njobs, initializer=initWorker, initargs=(calibfiles, force)) as p:
+            for run, nentries, seconds in p.imap_unordered(evaluateWorker, runs):
+                if nentries > 0:
+                    print(f"Run {run}: {nentries} events in {seconds:.1f} s")
+                ntotal += nentries
+    else:
+        initWorker(calibfiles, force)
+        for run in runs:
+            _, nentries, seconds = evaluateWorker(run)
+            if nentries > 0:
+                print(f"Run {run}: {nentries} events in {seconds:.1f} s")
+            ntotal += nentries
+    elapsed = time.time() - start
+    print(f"Evaluated {ntotal} events of {len(runs)} runs in {elapsed:.1f} s, "
+          f"{ntotal / max(elapsed, 1e-9):.0f} events/s")
+
+
+def EvaluateRunsBatched(runs, calibfiles, force=False, runsPerBatch=16, batchsize=65536, jit_compile=False):
+    """
+    apply the calibrations with the CNN inference batched across runs:
+    the events of runsPerBatch runs are concatenated and run through one compiled
+    inference function in batches of batchsize, then split back per run
+    """
+    start = time.time()
+    calibs = loadCalibrations(*calibfiles)
+    model, scales, mipcalibs = calibs
+    calibfiles = [fname for fname in calibfiles if fname != ""]
+    if model is None:
+        predict = None
+    elif isinstance(model, NumpyCNNModel):
+        def predict(chans):
+            return model.predict(chans, batchsize)
+    else:
+        from modules.CNNModel import makePredictFunction, predictBatched
+        tfpredict = makePredictFunction(model, jit_compile)
+
+        def predict(chans):
+            return predictBatched(chans, tfpredict, batchsize)
+
+    # runs to evaluate
+    todo = []
+    for run in runs:
+        outname, inputs, params = getOutput(
+            run, model, scales, mipcalibs, calibfiles)
+        if not force and isUpToDate(outname, inputs, params, code):
+            print(f"Run {run} is up to date, skipping")
+            continue
+        todo.append(run)
+
+    ntotal = 0
+    for i in range(0, len(todo), runsPerBatch):
+        group = todo[i:i+runsPerBatch]
+        chans = [toGrid(loadRunChannels([run])) for run in group]
+        outputs = [None] * len(group)
+        if predict is not None:
+            offsets = np.cumsum([0] + [c.shape[0] for c in chans])
+            predictions, weights = predict(np.concatenate(chans))
+            outputs = [(predictions[offsets[j]:offsets[j+1]], weights[offsets[j]:offsets[j+1]])
+                       for j in range(len(group))]
+        for run, c, out in zip(group, chans, outputs):
+            ntotal += Evaluate(run, model, scales, mipcalibs, calibfiles=calibfiles,
+                               force=True, chans=c, cnnoutputs=out)
+    elapsed = time.time() - start
+    print(f"Evaluated {ntotal} events of {len(todo)} runs in {elapsed:.1f} s, "
+          f"{ntotal / max(elapsed, 1e-9):.0f} events/s")
 
 
 if __name__ == "__main__":
@@ -135,38 +302,31 @@ if __name__ == "__main__":
     parser.add_argument("-l", "--file_linear", type=str,
                         default="", help="Linear regression file")
     parser.add_argument("-c", "--file_cnn", type=str,
-                        default="", help="CNN model file")
+                        default="", help="CNN model file, .keras or .npz exported with exportCNNModel.py")
     parser.add_argument("-s", "--start", type=int,
                         default=369, help="Run number to start")
     parser.add_argument("-e", "--end", type=int,
                         default=695, help="Run number to end")
+    parser.add_argument("-j", "--jobs", type=int, default=4,
+                        help="number of runs evaluated in parallel")
+    parser.add_argument("--batched", action="store_true",
+                        help="run the CNN inference on the events of several runs together, instead of the parallel runs")
+    parser.add_argument("--runs-per-batch", type=int, default=16,
+                        help="number of runs concatenated for the batched CNN inference")
+    parser.add_argument("--batchsize", type=int, default=65536,
+                        help="batch size of the batched CNN inference")
+    parser.add_argument("--jit", action="store_true",
+                        help="compile the batched CNN inference with XLA")
     args, unknown = parser.parse_known_args()
 
     run_start, run_end = args.start, args.end
     print(f"Selecting runs from {run_start} to {run_end}")
-
-    mipcalibs = None
-    if args.file_mipcalib != "":
-        fname = args.file_mipcalib
-        print(f"Using MIP calibration file: {fname}")
-        mipcalibs = loadResults(fname)
-        # linear regression has a bias term but not used.
-        # add a dummy value for the bias term, only place holder, not used
-        mipcalibs.append(1.0)
-        mipcalibs = np.array(mipcalibs)
-
-    linearcalibs = None
-    if args.file_linear != "":
-        fname = args.file_linear
-        print(f"Using Linear regression file: {fname}")
-        linearcalibs = loadResults(fname)
-        linearcalibs = np.array(linearcalibs)
-
-    cnnmodel = None
-    if args.file_cnn != "":
-        fname = args.file_cnn
-        print(f"Using CNN model file: {fname}")
-        cnnmodel = loadCNNModel(fname)
-
-    for i in range(run_start, run_end+1):
-        Evaluate(i, cnnmodel, linearcalibs, mipcalibs)
+    force = parseForce()
+    calibfiles = [args.file_mipcalib, args.file_linear, args.file_cnn]
+
+    if args.batched:
+        EvaluateRunsBatched(list(range(run_start, run_end+1)), calibfiles, force=force,
+                            runsPerBatch=args.runs_per_batch, batchsize=args.batchsize, jit_compile=args.jit)
+    else:
+        EvaluateRuns(list(range(run_start, run_end+1)), calibfiles,
+                     force=force, njobs=args.jobs)
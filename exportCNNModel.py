@@ -0,0 +1,38 @@
+# export the weights of a trained CNN model, such that it can be applied
+# with numpy only (modules/CNNNumpy.py), and check that both give the same outputs
+import numpy as np
+from modules.CNNModel import loadCNNModel, exportCNNWeights
+from modules.CNNNumpy import NumpyCNNModel
+
+
+def exportCNNModel(model_path, outname=None, nevents=10000):
+    if outname is None:
+        outname = model_path.replace(".keras", ".npz")
+    exportCNNWeights(model_path, outname)
+    print(f"Exported {model_path} to {outname}")
+
+    # compare on random showers
+    rng = np.random.default_rng(0)
+    chans = rng.exponential(
+        100.0, size=(nevents, 4, 4, 1)).astype(np.float32)
+    predictions, weights = loadCNNModel(model_path).predict(chans)
+    predictions_np, weights_np = NumpyCNNModel(outname).predict(chans)
+    diff_pred = np.max(np.abs(predictions_np - predictions) /
+                       np.maximum(np.abs(predictions), 1e-6))
+    diff_weight = np.max(np.abs(weights_np - weights))
+    print(f"max relative difference of the predictions: {diff_pred:.2e}")
+    print(f"max difference of the weights: {diff_weight:.2e}")
+    if diff_pred > 1e-4 or diff_weight > 1e-4:
+        raise RuntimeError(
+            f"numpy inference of {outname} does not reproduce {model_path}")
+    return outname
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model", type=str, help="CNN model file (.keras)")
+    parser.add_argument("-o", "--output", type=str, default=None,
+                        help="output npz file, default is the model file with .npz")
+    args, unknown = parser.parse_known_args()
+    exportCNNModel(args.model, args.output)
@@ -1,127 +1,205 @@
 # fit 16D data to 1D data with ROOT
 
 import ROOT
-import os
 import numpy as np
-from scipy.optimize import minimize
-from scipy.stats import norm
 from modules.fitFunction import fitFunction, saveResults
-from modules.runinfo import GetSelectionRange, GetRunInfo, CheckRunExists, GetRegressionGoal, GetTitle
-from modules.utils import plotCh1D, plotChMap, getChannelMap, plotCh2D, parseRuns
+from modules.runinfo import CheckRunExists, GetRegressionGoal, GetTitle
+from modules.utils import plotChMap, getChannelMap, parseRuns
+from modules.dataLoader import loadRunChannels, iterRunChannels, clearDataFrames
+from modules.linearSolver import solveL1IRLSStream, solveL1Minimize, bootstrapL1IRLS
 from modules.plotStyles import DrawHistos
 
 ROOT.gROOT.SetBatch(True)
 
 
-def ReadInputs(run_start, run_end):
-    t = ROOT.TChain("save")
+def getInputRuns(run_start, run_end):
+    runs = []
     for run in range(run_start, run_end):
-        fname = f"root_selected/Run{run}_list_selected.root"
-        if not os.path.exists(fname):
-            print(f"File {fname} does not exist")
-            continue
-
         if not CheckRunExists(run):
             print(f"Run {run} does not exist")
             continue
+        runs.append(run)
+    return runs
 
-        t.Add(fname)
-
-    nentries = t.GetEntries()
-    print(f"Number of entries: {nentries}")
-
-    chans = np.zeros((nentries, 16))
 
-    for i in range(nentries):
-        t.GetEntry(i)
-        for j in range(16):
-            chans[i][j] = t.ch_lg[j]
+def ReadInputs(run_start, run_end):
+    chans = loadRunChannels(getInputRuns(run_start, run_end), selected=True)
+    print(f"Number of entries: {chans.shape[0]}")
 
     return chans
 
 
-def runLinearRegression(chans, target):
-    nentries = chans.shape[0]
-    energys = np.ones(nentries) * target
-
-    def objective(params):
-        predictions = fitFunction(chans, params)
-        return np.sum(np.abs(predictions - energys))
-
-    initial_guess = np.ones(17)
-    b = [(0, None) for i in range(16)] + [(-100, 100)]
-    result = minimize(objective, initial_guess, bounds=b)
-
+def runLinearRegression(chunks, target, method="irls", x0=None, masks=None, maxiter=100):
+    """
+    L1 regression of the 16 channel scales to the target energy, with non-negative scales.
+    method: "irls" (iteratively reweighted least squares on the 16x16 Gram statistics,
+    at most maxiter passes over the chunks) or "minimize" (scipy L-BFGS-B with the
+    analytic gradient, which needs all the events in memory).
+    x0 is the starting point, masks the boolean selection of the events of each chunk
+    """
+    if method == "irls":
+        result = solveL1IRLSStream(
+            chunks, target, x0=x0, weights=masks, maxiter=maxiter)
+    elif method == "minimize":
+        chans = np.concatenate(list(chunks()))
+        mask = None if masks is None else np.concatenate(masks)
+        result = solveL1Minimize(chans, target, x0=x0, weights=mask)
+        del chans
+        if not result.success:
+            print(f"Warning: minimize did not converge: {result.message}")
+    else:
+        raise ValueError(f"Unknown regression method {method}")
+    print(f"{method}: {result.nit} iterations, objective {result.fun:.6g}")
     return result
 
 
-def selectEvents(chans, scales):
-    predictions = fitFunction(chans, scales)
-    mu, std = norm.fit(predictions)
+def getMoments(chunks, scales, masks=None):
+    """
+    mean and standard deviation (as norm.fit) of the predictions, over the chunks of events
+    """
+    n, s1, s2 = 0, 0.0, 0.0
+    for i, chans in enumerate(chunks()):
+        predictions = fitFunction(chans, scales)
+        if masks is not None:
+            predictions = predictions[masks[i]]
+        n += predictions.shape[0]
+        s1 += predictions.sum()
+        s2 += np.square(predictions).sum()
+    mu = s1 / n
+    return mu, np.sqrt(max(s2 / n - mu * mu, 0.0))
+
+
+def selectEvents(chunks, scales, masks=None):
+    """
+    select the events within [mu - 2 sigma, mu + 3 sigma] of the calibrated energy,
+    as one boolean mask per chunk. With masks, mu and sigma are computed on the
+    masked events, and the selection is restricted to them
+    """
+    mu, std = getMoments(chunks, scales, masks)
     print(f"mu = {mu}, sigma = {std}")
-    selection = ((predictions > mu - 2.0*std) & (predictions < mu + 3.0*std))
+    selection = []
+    for i, chans in enumerate(chunks()):
+        predictions = fitFunction(chans, scales)
+        sel = (predictions > mu - 2.0*std) & (predictions < mu + 3.0*std)
+        if masks is not None:
+            sel &= masks[i]
+        selection.append(sel)
     return selection, mu
 
 
-def RunLinearRegression(run_start, run_end):
-    chans = ReadInputs(run_start, run_end)
+def iterateRegression(chunks, target, maxiter=20, tol=1e-4, method="irls", maxpasses=100):
+    """
+    alternate the regression and the outlier rejection, starting each regression
+    from the previous scales, until the scales change by less than tol and the selection
+    is stable. chunks() returns a new iterator over the chunks of events,
+    the selection is kept as one boolean mask per chunk.
+    maxpasses is the maximum number of IRLS passes over the chunks per regression
+    """
+    masks = None
+    nselected = None
+    result = None
+    for i in range(maxiter):
+        print("Iteration ", i+1)
+        x0 = None if result is None else result.x
+        result = runLinearRegression(
+            chunks, target, method=method, x0=x0, masks=masks, maxiter=maxpasses)
+        masks, _ = selectEvents(chunks, result.x, masks)
+        nprev, nselected = nselected, sum(np.count_nonzero(m) for m in masks)
+        print("Number of selected events: ", nselected)
+        if x0 is not None and nselected == nprev and \
+                np.max(np.abs(result.x - x0)) <= tol * np.max(np.abs(result.x)):
+            print(f"Converged after {i+1} iterations")
+            break
+    return result, masks
+
+
+def RunLinearRegression(run_start, run_end, stream=False, chunksize=1 << 20, nboot=0, njobs=4, method="irls"):
+    """
+    with stream, the selected runs are read in chunks at every pass
+    instead of being loaded in memory together (only with the irls method).
+    With nboot > 0, the errors of the scales are estimated with nboot bootstrap
+    resamples of the selected events, refitted in njobs processes
+    """
     target = GetRegressionGoal(run_start)
-    chans_reg = chans.copy()
+    if stream and method != "irls":
+        raise ValueError(f"Method {method} needs the events in memory, use irls with --stream")
+    if stream:
+        runs = getInputRuns(run_start, run_end)
 
-    for i in range(20):
-        print("Iteration ", i+1)
-        result = runLinearRegression(chans_reg, target)
-        selection, _ = selectEvents(chans_reg, result.x)
-        chans_reg = chans_reg[selection]
-        print("Number of selected events: ", chans_reg.shape[0])
+        def chunks():
+            return iterRunChannels(runs, selected=True, chunksize=chunksize)
+    else:
+        allchans = ReadInputs(run_start, run_end)
+
+        def chunks():
+            return iter([allchans])
+
+    # each IRLS pass reads all the runs again in stream mode, cap their number
+    result, masks = iterateRegression(
+        chunks, target, method=method, maxpasses=20 if stream else 100)
 
-    predictions = fitFunction(chans, result.x)
-    mu, std = norm.fit(predictions)
+    mu, std = getMoments(chunks, result.x)
     print(f"mu = {mu}, std = {std}")
 
     # without regression
-    predictions_unc = fitFunction(chans, np.ones(17))
-    mu_unc, std_unc = norm.fit(predictions_unc)
+    mu_unc, std_unc = getMoments(chunks, np.ones(17))
     print(f"mu_unc = {mu_unc}, std_unc = {std_unc}")
 
+    scales = result.x.copy()
     baseChan = 12
     result.x = result.x / result.x[baseChan]
 
+    errors = np.zeros(result.x.shape[0])
+    if nboot > 0:
+        # refit the final selection, starting from the final scales
+        chans_sel = np.concatenate(
+            [chans[masks[i]] for i, chans in enumerate(chunks())])
+        print(f"Bootstrap with {nboot} resamples of {chans_sel.shape[0]} events")
+        xboot = bootstrapL1IRLS(chans_sel, target, x0=scales,
+                                nboot=nboot, njobs=njobs)
+        del chans_sel
+        xboot = xboot / xboot[:, baseChan:baseChan+1]
+        errors = xboot.std(axis=0, ddof=1)
+        print("errors: ", errors)
+
     # with regression
-    predictions_reg = fitFunction(chans_reg, result.x)
-    mu_reg, std_reg = norm.fit(predictions_reg)
+    mu_reg, std_reg = getMoments(chunks, result.x, masks)
     print(f"mu_reg = {mu_reg}, std_reg = {std_reg}")
 
     print(result.x)
 
-    nentries = chans.shape[0]
-
     # run the predictions
     ofile = ROOT.TFile(
         f"root_selected/Run_list_selected_calibrated_Run{run_start}_{run_end}.root", "RECREATE")
     hcal = ROOT.TH1F("hcal", "Calibrated Energy",
                      200, target-1000, target+1000)
-    hcal.FillN(nentries, predictions, np.ones(nentries))
-    hcal.Write()
     hcal_unc = ROOT.TH1F("hcal_unc", "Uncalibrated Energy",
                          200, target-1000, target+1000)
-    hcal_unc.FillN(nentries, predictions_unc, np.ones(nentries))
-    hcal_unc.Write()
     # hcal_reg is on the selected events for regression
     # only for debugging
     hcal_reg = ROOT.TH1F("hcal_reg", "Calibrated Energy (Reg)",
                          200, target-1000, target+1000)
-    hcal_reg.FillN(chans_reg.shape[0], predictions_reg,
-                   np.ones(chans_reg.shape[0]))
+    for i, chans in enumerate(chunks()):
+        nentries = chans.shape[0]
+        hcal.FillN(nentries, fitFunction(chans, scales), np.ones(nentries))
+        hcal_unc.FillN(nentries, fitFunction(
+            chans, np.ones(17)), np.ones(nentries))
+        predictions_reg = fitFunction(chans[masks[i]], result.x)
+        hcal_reg.FillN(predictions_reg.shape[0], predictions_reg,
+                       np.ones(predictions_reg.shape[0]))
+    hcal.Write()
+    hcal_unc.Write()
     hcal_reg.Write()
     ofile.Close()
+    # no more passes over the runs
+    clearDataFrames()
 
     h2D_mean = ROOT.TH2D("h2D_mean", "h2D_mean", 4, -0.5, 3.5, 4, -0.5, 3.5)
 
     for ch in range(16):
         x, y = getChannelMap(ch)
         h2D_mean.SetBinContent(x+1, y+1, result.x[ch])
-        h2D_mean.SetBinError(x+1, y+1, 0)
+        h2D_mean.SetBinError(x+1, y+1, errors[ch])
 
     title = GetTitle(run_start, run_end)
     DrawHistos([h2D_mean], [], -0.5, 3.5, "X", -0.5, 3.5, "Y", f"LinearRegression_Mean_Run{run_start}_Run{run_end}", dology=False, drawoptions="colz,text,ERROR", dologz=False, legendPos=(
@@ -131,9 +209,24 @@ def RunLinearRegression(run_start, run_end):
 
     # save the result to a json file
     saveResults(result.x.tolist(),
-                f"results/LinearRegression_Run{run_start}_Run{run_end}.json")
+                f"results/LinearRegression_Run{run_start}_Run{run_end}.json",
+                errors=errors.tolist() if nboot > 0 else None)
 
 
 if __name__ == "__main__":
+    import argparse
     run_start, run_end = parseRuns()
-    RunLinearRegression(run_start, run_end)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stream", action="store_true",
+                        help="read the runs in chunks at every pass instead of loading them in memory, for large run ranges")
+    parser.add_argument("--chunksize", type=int, default=1 << 20,
+                        help="number of events per chunk in stream mode")
+    parser.add_argument("--method", type=str, default="irls", choices=["irls", "minimize"],
+                        help="solver of the regression: irls on the Gram statistics or scipy minimize")
+    parser.add_argument("--bootstrap", type=int, default=0,
+                        help="number of bootstrap resamples for the errors of the scales, 0 for no errors")
+    parser.add_argument("-j", "--jobs", type=int, default=4,
+                        help="number of processes for the bootstrap fits")
+    args, unknown = parser.parse_known_args()
+    RunLinearRegression(run_start, run_end, stream=args.stream,
+                        chunksize=args.chunksize, nboot=args.bootstrap, njobs=args.jobs, method=args.method)
@@ -1,49 +1,153 @@
-from modules.utils import parseRuns, plotWeight, plotChSum, plotCh2D, plotCh1D
-from modules.runinfo import IsMuonRun
+from modules.utils import parseRuns, plotWeight, getEventCount, getCheckpointFile, getRunDataFrame, bookChSum, drawChSum, bookCh2D, drawCh2D, bookCh1D, drawCh1D
 import ROOT
 import os
-import sys
+import time
+from collections import OrderedDict
 ROOT.gROOT.SetBatch(True)
 
 
-def makePlot(run, doChSum=True, doCh2D=True, doCh1D=False, doWeight=False):
-    print("Making plots for run", run)
-    if doWeight:
-        # only works for regressed files with CNN
-        # not on input files
-        plotWeight(run)
-        return
-
+def bookPlots(run, doChSum=True, doCh2D=True, doCh1D=False):
+    """
+    book the plots of one run, without running the event loop yet
+    """
     fname = f"root/Run{run}_list.root"
+    if not os.path.exists(fname) and os.path.exists(fname + ".part"):
+        # run still being converted, plot the events written so far
+        fname = fname + ".part"
     if not os.path.exists(fname):
         print(f"File {fname} does not exist")
-        return
+        return None
 
     from modules.runinfo import GetEnergy
     energy = GetEnergy(run)
     if energy == None:
         print(f"Run {run} not found in runinfo")
-        return
+        return None
 
     f = ROOT.TFile(fname)
     t = f.Get("save")
 
-    # make plots of sum of ch_lg
+    # book all the plots first, such that they are filled in one event loop
+    rdf = getRunDataFrame(t)
+    # keep the file and the tree alive until the plots are drawn
+    booked = {"file": f, "tree": t, "energy": energy,
+              "handle": rdf.Count()}
     if doChSum:
-        print("plotting sum for run", run, "energy", energy, "GeV")
-        plotChSum(t, run)
+        booked["sum"] = bookChSum(rdf, run)
     if doCh2D:
-        print("plotting 2D for run", run, "energy", energy, "GeV")
-        plotCh2D(t, run)
+        booked["2D"] = bookCh2D(rdf, run)
     if doCh1D:
+        booked["1D"] = bookCh1D(rdf, run)
+    return booked
+
+
+def drawPlots(run, booked):
+    energy = booked["energy"]
+    # make plots of sum of ch_lg
+    if "sum" in booked:
+        print("plotting sum for run", run, "energy", energy, "GeV")
+        drawChSum(booked["sum"], run)
+    if "2D" in booked:
+        print("plotting 2D for run", run, "energy", energy, "GeV")
+        drawCh2D(booked["2D"], run)
+    if "1D" in booked:
         print("plotting 1D for run", run, "energy", energy, "GeV")
-        plotCh1D(t, run)
+        drawCh1D(booked["1D"], run)
+    booked["file"].Close()
+
+
+def makePlot(run, doChSum=True, doCh2D=True, doCh1D=False, doWeight=False):
+    print("Making plots for run", run)
+    if doWeight:
+        # only works for regressed files with CNN
+        # not on input files
+        plotWeight(run)
+        return
+
+    booked = bookPlots(run, doChSum, doCh2D, doCh1D)
+    if booked is None:
+        return
+    drawPlots(run, booked)
+
+
+def makePlots(runs, doChSum=True, doCh2D=True, doCh1D=False):
+    """
+    book the plots of all the runs, then run all their event loops
+    together with RunGraphs, which processes the runs concurrently with implicit MT
+    """
+    allbooked = OrderedDict()
+    for run in runs:
+        print("Booking plots for run", run)
+        booked = bookPlots(run, doChSum, doCh2D, doCh1D)
+        if booked is not None:
+            allbooked[run] = booked
+    if len(allbooked) == 0:
+        return
+
+    ROOT.RDF.RunGraphs([booked["handle"] for booked in allbooked.values()])
+
+    for run, booked in allbooked.items():
+        drawPlots(run, booked)
+
+
+def followPlots(runs, interval=60, timeout=600):
+    """
+    refresh the channel sum and 2D plots of the runs whenever
+    more events have been converted, e.g. with makeROOT.py --follow during data taking.
+    Returns once the conversion of all the runs is finished, i.e. their checkpoint
+    is removed and the final ROOT file exists. Runs without a list file are not followed,
+    and runs without new events for timeout seconds (the timeout of makeROOT.py --follow,
+    e.g. after a crashed conversion left its checkpoint behind) are given up
+    """
+    from makeROOT import getListFile
+    runs = [run for run in runs if os.path.exists(getListFile(run))]
+    nevents = {}
+    lastupdate = {run: time.time() for run in runs}
+    while True:
+        for run in runs:
+            n = getEventCount(run)
+            if n is None or n == nevents.get(run):
+                continue
+            print(f"Run {run} has {n} events")
+            nevents[run] = n
+            lastupdate[run] = time.time()
+            makePlot(run, doChSum=True, doCh2D=True, doCh1D=False)
+        running = []
+        for run in runs:
+            if not os.path.exists(getCheckpointFile(run)) and os.path.exists(f"root/Run{run}_list.root"):
+                continue
+            if time.time() - lastupdate[run] > timeout:
+                print(f"No new events in Run {run} for {timeout} seconds, not following it anymore")
+                continue
+            running.append(run)
+        runs = running
+        if len(runs) == 0:
+            print("All the runs are converted")
+            return
+        time.sleep(interval)
 
 
 if __name__ == "__main__":
+    import argparse
     run_start, run_end = parseRuns()
-    for i in range(run_start, run_end):
-        makePlot(i, doChSum=True, doCh2D=True, doCh1D=True, doWeight=False)
-        # if IsMuonRun(i):
-        #    makePlot(i, doChSum=False, doCh2D=False,
-        #             doCh1D=True, doWeight=False)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--follow", action="store_true",
+                        help="keep refreshing the plots as new events are converted")
+    parser.add_argument("--interval", type=int, default=60,
+                        help="seconds between refreshes in follow mode")
+    parser.add_argument("--timeout", type=int, default=600,
+                        help="seconds without new events after which a run is not followed anymore")
+    parser.add_argument("-t", "--threads", type=int, default=8,
+                        help="number of threads to process the runs concurrently")
+    args, unknown = parser.parse_known_args()
+    if args.threads > 1:
+        ROOT.EnableImplicitMT(args.threads)
+    if args.follow:
+        followPlots(range(run_start, run_end), args.interval, args.timeout)
+
+    makePlots(range(run_start, run_end), doChSum=True,
+              doCh2D=True, doCh1D=True)
+    # for i in range(run_start, run_end):
+    #    if IsMuonRun(i):
+    #        makePlot(i, doChSum=False, doCh2D=False,
+    #                 doCh1D=True, doWeight=False)
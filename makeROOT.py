@@ -1,108 +1,237 @@
 from multiprocessing import Pool, current_process
 from array import array
+import numpy as np
 import ROOT
 import sys
 import os
+from modules.listParser import readListBlocks, followListBlocks, blocksize, nchannels
+from modules.utils import writeSchemaVersion, schema_vector, schema_array, getCheckpointFile, saveCheckpoint, loadCheckpoint
+from modules.runCache import appendRunCache, clearRunCache, removeRunCache, finalizeRunCache, truncateRunCache, hasRunCache
+from modules.manifest import isUpToDate, recordManifest, parseForce
+from modules import listParser, runCache
 sys.argv.append('-b')
 
 ROOT.gROOT.SetBatch(True)
 
-chlist = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15]
-chlist_str = ["00", "01", "02", "03", "04", "05", "06",
-              "07", "08", "09", "10", "11", "12", "13", "14", "15"]
-
-
-def convertStrToVal(ch):
-    if ch == "-":
-        return 0
-    else:
-        return int(ch)
-
-
-def makeROOT(run):
+# source files of this stage, for the manifests
+code = [__file__, listParser.__file__, runCache.__file__]
+
+# fill the whole block of parsed events in C++, instead of one python call per event
+ROOT.gInterpreter.Declare("""
+void fillJanusTree(TTree *t, long nevents, int nch, const int *trigID, const double *trigTime, const int *lg, const int *hg, bool fixedsize)
+{
+    int id = 0;
+    double time = 0;
+    std::vector<int> vlg(nch), vhg(nch);
+    std::vector<int> *plg = &vlg, *phg = &vhg;
+    std::vector<unsigned short> alg(nch), ahg(nch);
+    t->SetBranchAddress("trigID", &id);
+    t->SetBranchAddress("trigTime", &time);
+    if (fixedsize) {
+        t->SetBranchAddress("ch_lg", alg.data());
+        t->SetBranchAddress("ch_hg", ahg.data());
+    } else {
+        t->SetBranchAddress("ch_lg", &plg);
+        t->SetBranchAddress("ch_hg", &phg);
+    }
+    for (long i = 0; i < nevents; i++) {
+        id = trigID[i];
+        time = trigTime[i];
+        if (fixedsize) {
+            for (int j = 0; j < nch; j++) {
+                alg[j] = std::clamp(lg[i * nch + j], 0, 65535);
+                ahg[j] = std::clamp(hg[i * nch + j], 0, 65535);
+            }
+        } else {
+            std::copy(lg + i * nch, lg + (i + 1) * nch, vlg.begin());
+            std::copy(hg + i * nch, hg + (i + 1) * nch, vhg.begin());
+        }
+        t->Fill();
+    }
+    t->ResetBranchAddresses();
+}
+""")
+
+
+def fillTree(tout, events, fixedsize=False):
+    nevents = len(events["trigID"])
+    ROOT.fillJanusTree(tout, nevents, nchannels,
+                       np.ascontiguousarray(events["trigID"], dtype=np.int32),
+                       np.ascontiguousarray(
+                           events["trigTime"], dtype=np.float64),
+                       np.ascontiguousarray(events["ch_lg"], dtype=np.int32),
+                       np.ascontiguousarray(events["ch_hg"], dtype=np.int32),
+                       fixedsize)
+    return nevents
+
+
+def getListFile(run):
     # check if we are on sqtestbench.mit.edu
     if os.getenv('HOSTNAME') == 'sqtestbench':
         data_dir = '/storage/spinquest/emcal'
     else:
         # assume the user has made a local data directory 
         data_dir = 'data'
-    # check if file exists
-    if not os.path.exists(f"{data_dir}/Run{run}_list.txt"):
-        print(f"File {data_dir}/Run{run}_list.txt does not exist")
-        return
+    return f"{data_dir}/Run{run}_list.txt"
 
-    pid = current_process().pid
 
-    print(f"Making ROOT file for Run {run} with Process ID: {pid}")
+def createTree(fout, fixedsize=False):
     trigID = array('i', [0])
     trigTime = array('d', [0])
-    ch_lg = ROOT.std.vector[int]()
-    ch_hg = ROOT.std.vector[int]()
+    if fixedsize:
+        ch_lg = np.zeros(nchannels, dtype=np.uint16)
+        ch_hg = np.zeros(nchannels, dtype=np.uint16)
+    else:
+        ch_lg = ROOT.std.vector[int]()
+        ch_hg = ROOT.std.vector[int]()
 
-    fout = ROOT.TFile(f"root/Run{run}_list.root", "RECREATE")
     tout = ROOT.TTree("save", "save")
     tout.SetDirectory(fout)
 
     tout.Branch('trigID', trigID, 'trigID/I')
-    tout.SetBranchAddress("trigID", trigID)
-
     tout.Branch('trigTime', trigTime, 'trigTime/D')
-    tout.SetBranchAddress("trigTime", trigTime)
+    if fixedsize:
+        tout.Branch('ch_lg', ch_lg, f'ch_lg[{nchannels}]/s')
+        tout.Branch('ch_hg', ch_hg, f'ch_hg[{nchannels}]/s')
+    else:
+        tout.Branch('ch_lg', ch_lg)
+        tout.Branch('ch_hg', ch_hg)
+    # the addresses are set by fillJanusTree
+    tout.ResetBranchAddresses()
+    return tout
+
+
+def makeROOT(run, size=blocksize, outformat="vector", writeCache=False, resume=False, follow=False, force=False):
+    """
+    convert the Janus list file of one run to the 'save' tree.
+    outformat "vector" writes ch_lg and ch_hg as std::vector<int>,
+    "array" writes them as fixed-size ch_lg[16]/s arrays.
+    writeCache also saves the columns as memory-mappable .npy files in cache/Run{run}/
+
+    The tree is written to Run{run}_list.root.part and saved after every block,
+    together with a checkpoint of the byte offset in the list file and the number of events.
+    With resume, an interrupted conversion continues from the last checkpoint.
+    The file is renamed to Run{run}_list.root only once the conversion is complete.
+
+    With follow, the list file of a run that is still being recorded is tailed and the new
+    events are appended as they arrive, until the file stops growing. The events written
+    so far are readable from the .part file, and their number from the checkpoint.
+
+    Runs whose list file and options have not changed since the last conversion are skipped,
+    unless force is True.
+    """
+    fname_in = getListFile(run)
+    # check if file exists
+    if not os.path.exists(fname_in):
+        print(f"File {fname_in} does not exist")
+        return
+
+    fname = f"root/Run{run}_list.root"
+    params = {"format": outformat, "cache": writeCache}
+    if not force and not follow and isUpToDate(fname, [fname_in], params, code) \
+            and (not writeCache or hasRunCache(run)):
+        print(f"Run {run} is up to date, skipping")
+        return
 
-    tout.Branch('ch_lg', ch_lg)
-    tout.SetBranchAddress("ch_lg", ch_lg)
+    pid = current_process().pid
 
-    tout.Branch('ch_hg', ch_hg)
-    tout.SetBranchAddress("ch_hg", ch_hg)
+    print(f"Making ROOT file for Run {run} with Process ID: {pid}")
+    fixedsize = outformat == "array"
+    fname_part = fname + ".part"
+    fname_ckpt = getCheckpointFile(run)
 
+    offset = 0
     nevents = 0
-
-    with open(f"{data_dir}/Run{run}_list.txt") as infile:
-        for line in infile:
-            if ("//" in line):
-                continue
-            if ("Tstamp" in line):
-                continue
-
-            if ("1  00" in line and len(line.split()) == 7):
-                trigID[0] = int(line.split()[5])
-                trigTime[0] = float(line.split()[4])
-
-            for ch in chlist:
-                if ("1  "+chlist_str[ch] in line):
-                    ch_lg.push_back(convertStrToVal(line.split()[2]))
-                    ch_hg.push_back(convertStrToVal(line.split()[3]))
-
-            if (ch_lg.size() == len(chlist)):
-                tout.Fill()
-                ch_lg.clear()
-                ch_hg.clear()
-                nevents += 1
-                if (nevents % 10000 == 0):
-                    print(
-                        f"Process ID: {pid}, Run {run}, and processed {nevents} events")
+    fout = None
+    checkpoint = loadCheckpoint(fname_ckpt) if resume else None
+    if checkpoint and checkpoint["format"] == outformat and checkpoint["cache"] == writeCache \
+            and os.path.exists(fname_part):
+        fout = ROOT.TFile(fname_part, "UPDATE")
+        tout = fout.Get("save") if not fout.IsZombie() else None
+        if tout and tout.GetEntries() == checkpoint["nevents"] and \
+                (not writeCache or truncateRunCache(run, checkpoint["nevents"])):
+            offset = checkpoint["offset"]
+            nevents = checkpoint["nevents"]
+            print(
+                f"Resuming Run {run} from byte {offset} with {nevents} events")
+        else:
+            print(
+                f"Checkpoint of Run {run} does not match {fname_part}, restarting")
+            fout.Close()
+            fout = None
+
+    if fout is None:
+        fout = ROOT.TFile(fname_part, "RECREATE")
+        tout = createTree(fout, fixedsize)
+        # the cache of the previous conversion does not match the new ROOT file
+        if writeCache:
+            clearRunCache(run)
+        else:
+            removeRunCache(run)
+
+    # the list file is parsed in blocks of events
+    if follow:
+        blocks = followListBlocks(fname_in, offset=offset, size=size)
+    else:
+        blocks = readListBlocks(fname_in, offset=offset, size=size)
+    for events, offset in blocks:
+        nevents += fillTree(tout, events, fixedsize)
+        if writeCache:
+            appendRunCache(run, events)
+        # make sure the events are on disk before moving the checkpoint
+        tout.AutoSave("SaveSelf")
+        saveCheckpoint(fname_ckpt, {"offset": offset, "nevents": nevents,
+                                    "format": outformat, "cache": writeCache})
+        print(
+            f"Process ID: {pid}, Run {run}, and processed {nevents} events")
 
     fout.cd()
-    tout.Write()
-    fout.Save()
+    tout.Write("", ROOT.TObject.kOverwrite)
+    writeSchemaVersion(fout, schema_array if fixedsize else schema_vector)
+    fout.Close()
+    os.replace(fname_part, fname)
+    if writeCache:
+        finalizeRunCache(run)
+        print(f"Columnar cache saved in cache/Run{run}/")
+    if os.path.exists(fname_ckpt):
+        os.remove(fname_ckpt)
+    recordManifest(fname, [fname_in], params, code)
 
     print(f"Total events: {nevents}")
-    print(f"ROOT file saved as root/Run{run}_list.root with Process ID: {pid}")
+    print(f"ROOT file saved as {fname} with Process ID: {pid}")
     print("\n\n")
 
 
-def worker(run):
-    makeROOT(run)
+def worker(run, size=blocksize, outformat="vector", writeCache=False, resume=False, follow=False, force=False):
+    makeROOT(run, size=size, outformat=outformat,
+             writeCache=writeCache, resume=resume, follow=follow, force=force)
 
 
 if __name__ == "__main__":
     from modules.utils import parseRuns
+    from functools import partial
+    import argparse
     run_start, run_end = parseRuns()
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-f", "--format", type=str, default="vector", choices=["vector", "array"],
+                        help="layout of ch_lg and ch_hg: std::vector<int> or fixed-size arrays")
+    parser.add_argument("--cache", action="store_true",
+                        help="also write the columnar numpy cache in cache/Run{run}/")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue interrupted conversions from their last checkpoint")
+    parser.add_argument("--blocksize", type=int, default=blocksize // (1024 * 1024),
+                        help="size in MB of the blocks read from the list file between checkpoints")
+    parser.add_argument("--follow", action="store_true",
+                        help="keep converting the runs that are still being recorded, until their list files stop growing")
+    args, unknown = parser.parse_known_args()
+
     # see if output directory exists
     if not os.path.exists('./root/'):
         print('Output rootfile directory "root/" does not exist, please create first;\n\tmkdir ./root')
         exit()
 
     with Pool(16) as p:
-        p.map(worker, range(run_start, run_end))
+        p.map(partial(worker, size=args.blocksize * 1024 * 1024, outformat=args.format,
+                      writeCache=args.cache, resume=args.resume, follow=args.follow, force=parseForce()),
+              range(run_start, run_end))
@@ -1,12 +1,20 @@
 import ROOT
 import os
 import sys
+from multiprocessing import Pool
+from functools import partial
 from modules.runinfo import GetSelectionRange, GetRunInfo, CheckRunExists
+from modules.manifest import isUpToDate, recordManifest, parseForce
+from modules import utils, runinfo, geometry
 
 ROOT.gROOT.SetBatch(True)
 
+# source files of this stage, for the manifests.
+# utils has the ADC sum, the schema handling and the histogram bookers
+code = [__file__, utils.__file__, runinfo.__file__, geometry.__file__]
 
-def select(run):
+
+def select(run, force=False):
     fname = f"root/Run{run}_list.root"
     if not os.path.exists(fname):
         print(f"File {fname} does not exist")
@@ -23,6 +31,12 @@ def select(run):
         return
     xmin, xmax = xranges[0], xranges[1]
 
+    outname = f"root_selected/Run{run}_list_selected.root"
+    params = {"xmin": xmin, "xmax": xmax}
+    if not force and isUpToDate(outname, [fname], params, code):
+        print(f"Run {run} is up to date, skipping")
+        return
+
     f = ROOT.TFile(fname)
     t = f.Get("save")
     nentries = t.GetEntries()
@@ -36,32 +50,59 @@ def select(run):
     lmax.SetLineColor(ROOT.kGreen)
     lmax.SetLineWidth(2)
     lmax.SetLineStyle(2)
-    from modules.utils import plotChSum, plotCh2D
-    plotChSum(t, run, xmin=0.6*xmin, xmax=xmax *
-              1.3, outdir="plots/Selections/ChSum", extraToDraws=[lmin, lmax])
-    plotCh2D(t, run, xmin=xmin, xmax=xmax, outdir="plots/Selections/Ch2D")
-
-    # create a new file
-    fout = ROOT.TFile(f"root_selected/Run{run}_list_selected.root", "RECREATE")
-    tout = t.CloneTree(0)
-
-    nevts = 0
-    for i in range(nentries):
-        t.GetEntry(i)
-        if sum(t.ch_lg) > xmin and sum(t.ch_lg) < xmax:
-            tout.Fill()
-            nevts += 1
-
-    tout.Write()
-    fout.Close()
+    from modules.utils import getRunDataFrame, bookChSum, drawChSum, bookCh2D, drawCh2D, getSchemaVersion, writeSchemaVersion
+
+    # book the plots and the selected events, such that they are all
+    # produced in one (multithreaded) event loop
+    schema = getSchemaVersion(t)
+    rdf = getRunDataFrame(t)
+    hsum = bookChSum(rdf, run, xmin=0.6*xmin, xmax=xmax * 1.3)
+    h2D = bookCh2D(rdf, run, xmin=xmin, xmax=xmax)
+    rdf_sel = rdf.Filter(f"ADCSum > {xmin} && ADCSum < {xmax}")
+    nevts = rdf_sel.Count()
+    opts = ROOT.RDF.RSnapshotOptions()
+    opts.fLazy = True
+    # written to a temporary file and renamed once complete, such that an interrupted
+    # selection never leaves a partial output for the next stages
+    snapshot = rdf_sel.Snapshot(
+        "save", outname + ".part", ["trigID", "trigTime", "ch_lg", "ch_hg"], opts)
+
+    # run the event loop
+    snapshot.GetValue()
+    nevts = nevts.GetValue()
+
+    drawChSum(hsum, run, xmin=0.6*xmin, xmax=xmax * 1.3,
+              outdir="plots/Selections/ChSum", extraToDraws=[lmin, lmax])
+    drawCh2D(h2D, run, outdir="plots/Selections/Ch2D")
     f.Close()
 
+    fout = ROOT.TFile(outname + ".part", "UPDATE")
+    writeSchemaVersion(fout, schema)
+    fout.Close()
+    os.replace(outname + ".part", outname)
+    recordManifest(outname, [fname], params, code)
+
     print(
         f"Selected {nevts} out of {nentries} events for Run {run}, with cut on min sum ch_lg {xmin} and max {xmax}, efficiency = {nevts/(nentries+1e-3):.2f}")
 
 
+def enableMT(nthreads):
+    if nthreads > 1:
+        ROOT.EnableImplicitMT(nthreads)
+
+
 if __name__ == "__main__":
     from modules.utils import parseRuns
+    import argparse
     run_start, run_end = parseRuns()
-    for i in range(run_start, run_end+1):
-        select(i)
+    force = parseForce()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-j", "--jobs", type=int, default=4,
+                        help="number of runs processed in parallel")
+    parser.add_argument("-t", "--threads", type=int, default=4,
+                        help="number of threads for the event loop of each run")
+    args, unknown = parser.parse_known_args()
+
+    with Pool(args.jobs, initializer=enableMT, initargs=(args.threads,)) as p:
+        p.map(partial(select, force=force), range(run_start, run_end+1))
@@ -1,3 +1,4 @@
+import numpy as np
 import tensorflow as tf
 from tensorflow.keras import layers, models
 
@@ -48,3 +49,46 @@ def loadCNNModel(model_path):
     intermediate_layer_model = models.Model(
         inputs=best_model.input, outputs=best_model.get_layer('custom_conv_layer').output)
     return intermediate_layer_model
+
+
+def makePredictFunction(model, jit_compile=False):
+    """
+    compiled inference of the model, with XLA if jit_compile.
+    Returns a function of a batch returning (predictions, weights)
+    """
+    @tf.function(jit_compile=jit_compile, reduce_retracing=True)
+    def predict(x):
+        return model(x, training=False)
+    return predict
+
+
+def predictBatched(chans, predict, batchsize=65536):
+    """
+    run predict on chans in batches of batchsize events.
+    The last batch is padded to batchsize, such that predict is only traced once
+    """
+    nentries = chans.shape[0]
+    predictions = np.zeros(nentries, dtype=np.float32)
+    weights = np.zeros(chans.shape, dtype=np.float32)
+    for start in range(0, nentries, batchsize):
+        batch = chans[start:start+batchsize]
+        n = batch.shape[0]
+        if n < batchsize:
+            batch = np.concatenate(
+                [batch, np.zeros((batchsize - n,) + batch.shape[1:], dtype=batch.dtype)])
+        p, w = predict(tf.constant(batch, dtype=tf.float32))
+        predictions[start:start+n] = p.numpy()[:n]
+        weights[start:start+n] = w.numpy()[:n]
+    return predictions, weights
+
+
+def exportCNNWeights(model_path, outname):
+    """
+    save the conv weights of a trained model to a npz file, for modules.CNNNumpy
+    """
+    model = loadCNNModel(model_path)
+    layer = model.get_layer('custom_conv_layer')
+    kernel1, bias1 = layer.conv1.get_weights()
+    kernel2, bias2 = layer.conv2.get_weights()
+    np.savez(outname, conv1_kernel=kernel1, conv1_bias=bias1,
+             conv2_kernel=kernel2, conv2_bias=bias2)
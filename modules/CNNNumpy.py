@@ -0,0 +1,82 @@
+# numpy inference of the CNN calibration model, from the weights exported
+# with exportCNNModel.py, such that applying the model does not need tensorflow
+import numpy as np
+
+
+def loadCNNWeights(fname):
+    with np.load(fname) as f:
+        return {key: f[key] for key in f.files}
+
+
+def conv2DSame(x, kernel, bias):
+    """
+    stride 1 convolution with 'same' padding, as keras Conv2D:
+    x is (N, H, W, C), kernel (kh, kw, C, F), returns (N, H, W, F).
+    The padding is (k-1)//2 before and the rest after, in each direction
+    """
+    kh, kw = kernel.shape[:2]
+    x = np.pad(x, ((0, 0), ((kh-1)//2, kh//2), ((kw-1)//2, kw//2), (0, 0)))
+    # im2col: (N, H, W, C, kh, kw) view of the patches
+    cols = np.lib.stride_tricks.sliding_window_view(x, (kh, kw), axis=(1, 2))
+    return np.tensordot(cols, kernel.transpose(2, 0, 1, 3), axes=3) + bias
+
+
+def convMatrix(kernel, nx, ny):
+    """
+    conv2DSame on a (nx, ny) grid as a dense (nx*ny*C, nx*ny*F) matrix,
+    obtained by convolving the unit inputs. On the small calorimeter grid
+    this turns each convolution into a single matrix product
+    """
+    nin = nx * ny * kernel.shape[2]
+    basis = np.eye(nin, dtype=np.float32).reshape(nin, nx, ny, kernel.shape[2])
+    return conv2DSame(basis, kernel, 0).reshape(nin, -1).astype(np.float32)
+
+
+def getConvMatrices(weights, nx, ny):
+    return (convMatrix(weights["conv1_kernel"], nx, ny), np.tile(weights["conv1_bias"], nx * ny),
+            convMatrix(weights["conv2_kernel"], nx, ny), np.tile(weights["conv2_bias"], nx * ny))
+
+
+def predictNumpy(weights, chans, matrices=None):
+    """
+    forward pass of CustomConvLayer on chans (N, nx, ny, 1).
+    Returns (predictions, weight_estimated) as loadCNNModel(...).predict.
+    matrices are the getConvMatrices of the weights, computed if not given
+    """
+    chans = np.asarray(chans, dtype=np.float32)
+    nevents, nx, ny = chans.shape[:3]
+    if matrices is None:
+        matrices = getConvMatrices(weights, nx, ny)
+    m1, b1, m2, b2 = matrices
+    x = chans.reshape(nevents, -1)
+    x = x / (x.sum(axis=1, keepdims=True) + 1e-6)
+    x = np.maximum(x @ m1 + b1, 0)
+    x = x @ m2 + b2
+    weight_estimated = (1.0 / (1.0 + np.exp(-x))) * 0.4 + 0.8
+    predictions = np.sum(weight_estimated * chans.reshape(nevents, -1), axis=1)
+    return predictions.astype(np.float32), weight_estimated.reshape(chans.shape).astype(np.float32)
+
+
+class NumpyCNNModel:
+    """
+    drop-in for the model of loadCNNModel, for inference only
+    """
+
+    def __init__(self, fname):
+        self.weights = loadCNNWeights(fname)
+        self.matrices = {}
+
+    def predict(self, chans, batchsize=65536):
+        shape = chans.shape[1:3]
+        if shape not in self.matrices:
+            self.matrices[shape] = getConvMatrices(self.weights, *shape)
+        predictions = []
+        weights = []
+        for start in range(0, chans.shape[0], batchsize):
+            p, w = predictNumpy(
+                self.weights, chans[start:start+batchsize], self.matrices[shape])
+            predictions.append(p)
+            weights.append(w)
+        if len(predictions) == 0:
+            return np.zeros(0, dtype=np.float32), np.zeros(chans.shape, dtype=np.float32)
+        return np.concatenate(predictions), np.concatenate(weights)
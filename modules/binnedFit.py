@@ -0,0 +1,114 @@
+# binned maximum likelihood fit of a gaussian in a range, with numpy and scipy only.
+# Same likelihood as the RooFit fit of runFit (pdf at the bin centers, normalized
+# to the fit range), with analytic gradients, for fitting many histograms quickly
+import numpy as np
+from scipy.optimize import minimize
+from scipy.special import ndtr
+from scipy.stats import chi2 as _chi2
+
+_sqrt2pi = np.sqrt(2.0 * np.pi)
+
+
+def _phi(z):
+    return np.exp(-0.5 * z * z) / _sqrt2pi
+
+
+def gaussianNLL(params, x, n, a, b):
+    """
+    negative log likelihood (up to a constant) of the counts n at the bin centers x
+    for a gaussian normalized in [a, b], and its gradient
+    """
+    mean, sigma = params
+    z = (x - mean) / sigma
+    za, zb = (a - mean) / sigma, (b - mean) / sigma
+    norm = max(ndtr(zb) - ndtr(za), 1e-300)
+    ntot = n.sum()
+    nll = np.sum(n * (0.5 * z * z)) + ntot * np.log(sigma) + ntot * np.log(norm)
+    dnorm_dmean = (_phi(za) - _phi(zb)) / sigma
+    dnorm_dsigma = (za * _phi(za) - zb * _phi(zb)) / sigma
+    grad = np.array([
+        -np.sum(n * z) / sigma + ntot * dnorm_dmean / norm,
+        -np.sum(n * z * z) / sigma + ntot / sigma + ntot * dnorm_dsigma / norm,
+    ])
+    return nll, grad
+
+
+def getHessian(params, args, steps):
+    """
+    hessian from central differences of the analytic gradient
+    """
+    npar = len(params)
+    hess = np.zeros((npar, npar))
+    for i in range(npar):
+        dp = np.zeros(npar)
+        dp[i] = steps[i]
+        hess[i] = (gaussianNLL(params + dp, *args)[1] -
+                   gaussianNLL(params - dp, *args)[1]) / (2 * steps[i])
+    return 0.5 * (hess + hess.T)
+
+
+def getChi2NDF(n, expected):
+    """
+    chi2/ndf of the expected counts against the data, with the asymmetric
+    poisson errors of the data, as RooPlot::chiSquare
+    """
+    low = n - np.where(n > 0, _chi2.ppf(0.158655, 2 * n) / 2, 0.0)
+    high = _chi2.ppf(0.841345, 2 * (n + 1)) / 2 - n
+    err = np.where(n > expected, low, high)
+    valid = err > 0
+    if np.count_nonzero(valid) == 0:
+        return 0.0
+    pulls = (n[valid] - expected[valid]) / err[valid]
+    return float(np.sum(pulls * pulls) / np.count_nonzero(valid))
+
+
+def fitGaussianBinned(edges, contents, xmin, xmax, xfitmin, xfitmax, mean0, sigma0, bounds):
+    """
+    fit the histogram (edges, contents) with a gaussian in [xfitmin, xfitmax].
+    Bins are used if their center is in the range, as RooFit does.
+    bounds are the ((min, max), (min, max)) of the mean and sigma.
+    Returns values, errors, covariance, status (0 if converged), covQual (3 if the
+    covariance is positive definite, 0 if not) and the chi2/ndf in [xfitmin, xfitmax].
+    xmin and xmax are the plot range, which does not enter the fit
+    """
+    edges = np.asarray(edges, dtype=np.float64)
+    contents = np.asarray(contents, dtype=np.float64)
+    centers = 0.5 * (edges[1:] + edges[:-1])
+    widths = edges[1:] - edges[:-1]
+    infit = (centers >= xfitmin) & (centers <= xfitmax)
+    args = (centers[infit], contents[infit], xfitmin, xfitmax)
+
+    start = np.clip([mean0, sigma0], [bounds[0][0], bounds[1][0]],
+                    [bounds[0][1], bounds[1][1]])
+    res = minimize(gaussianNLL, start, args=args, jac=True,
+                   method="L-BFGS-B", bounds=bounds)
+    values = res.x
+
+    # errors from the hessian of the nll (0.5 up)
+    hess = getHessian(values, args, np.maximum(
+        1e-4 * np.abs(values), 1e-6))
+    try:
+        np.linalg.cholesky(hess)
+        covariance = np.linalg.inv(hess)
+        covQual = 3
+    except np.linalg.LinAlgError:
+        covariance = np.linalg.pinv(hess)
+        covQual = 0
+    errors = np.sqrt(np.abs(np.diag(covariance)))
+
+    # expected counts in the fit range, normalized to the events in the fit range,
+    # as the curve drawn in the fit range on which RooPlot::chiSquare is computed
+    mean, sigma = values
+    norm = ndtr((xfitmax - mean) / sigma) - ndtr((xfitmin - mean) / sigma)
+    expected = contents[infit].sum() * widths[infit] * \
+        _phi((centers[infit] - mean) / sigma) / sigma / max(norm, 1e-300)
+    chi2ndf = getChi2NDF(contents[infit], expected)
+
+    return {
+        "values": values,
+        "errors": errors,
+        "covariance": covariance,
+        "status": 0 if res.success else 1,
+        "covQual": covQual,
+        "chi2ndf": chi2ndf,
+    }
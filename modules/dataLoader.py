@@ -0,0 +1,137 @@
+# bulk loading of the channel ADCs into numpy arrays,
+# instead of looping over the events with GetEntry in python
+import os
+import numpy as np
+import ROOT
+from .runCache import loadRunCache, getCachePath, cachedir
+from .geometry import geometry
+
+nchannels = geometry["nchannels"]
+
+
+def getRunFile(run, selected=False):
+    if selected:
+        return f"root_selected/Run{run}_list_selected.root"
+    return f"root/Run{run}_list.root"
+
+
+# RDataFrames with the channel columns defined, kept by iterRunChannels such that
+# reading the same files at every pass of the streaming regression does not rebuild them
+_dataframes = {}
+
+
+def getChannelDataFrame(fnames, branch="ch_lg", treename="save", cache=False):
+    """
+    RDataFrame of the files with one float column per channel of the branch.
+    With cache, it is built once per list of files and kept until clearDataFrames.
+    Returns the dataframe and the column names
+    """
+    key = (tuple(fnames), branch, treename)
+    if key in _dataframes:
+        return _dataframes[key]
+    rdf = ROOT.RDataFrame(treename, list(fnames))
+    cols = []
+    for ch in range(nchannels):
+        rdf = rdf.Define(f"{branch}_{ch}",
+                         f"static_cast<float>({branch}[{ch}])")
+        cols.append(f"{branch}_{ch}")
+    if cache:
+        _dataframes[key] = (rdf, cols)
+    return rdf, cols
+
+
+def clearDataFrames():
+    """
+    release the RDataFrames kept by getChannelDataFrame, with their files
+    """
+    _dataframes.clear()
+
+
+def loadChannels(fnames, branch="ch_lg", treename="save", cache=False):
+    """
+    read one of the channel branches from a list of ROOT files with RDataFrame
+    and return it as a contiguous (nevents, nchannels) float32 array.
+    cache keeps the RDataFrame for the next reads of the same files
+    """
+    if len(fnames) == 0:
+        return np.zeros((0, nchannels), dtype=np.float32)
+
+    rdf, cols = getChannelDataFrame(fnames, branch, treename, cache)
+    arrays = rdf.AsNumpy(cols)
+    return np.ascontiguousarray(np.column_stack([arrays[col] for col in cols]), dtype=np.float32)
+
+
+def loadRunChannels(runs, selected=False, branch="ch_lg"):
+    """
+    load the channel ADCs of a list of runs as a (nevents, nchannels) float32 array.
+    The raw runs are read from the columnar cache when it exists.
+    Runs without a file are skipped.
+    """
+    chans = []
+    # consecutive runs without cache are read with one RDataFrame
+    fnames = []
+    for run in runs:
+        cache = None if selected else loadRunCache(
+            run, [branch], source=getRunFile(run))
+        if cache is not None:
+            chans.append(loadChannels(fnames, branch))
+            fnames = []
+            chans.append(np.asarray(cache[branch], dtype=np.float32))
+            continue
+        fname = getRunFile(run, selected)
+        if not os.path.exists(fname):
+            print(f"File {fname} does not exist")
+            continue
+        fnames.append(fname)
+    chans.append(loadChannels(fnames, branch))
+    return np.concatenate(chans)
+
+
+def iterRunChannels(runs, selected=False, branch="ch_lg", chunksize=1 << 20):
+    """
+    same as loadRunChannels, but yield the events in (chunksize, nchannels) chunks,
+    such that the runs never need to be in memory all together.
+    Each ROOT file is read with a single event loop, so at most one run is in memory.
+    The RDataFrames are kept for the next passes, call clearDataFrames once done
+    """
+    for run in runs:
+        cache = None if selected else loadRunCache(
+            run, [branch], source=getRunFile(run))
+        if cache is not None:
+            chans = cache[branch]
+            for start in range(0, chans.shape[0], chunksize):
+                yield np.asarray(chans[start:start+chunksize], dtype=np.float32)
+            continue
+        fname = getRunFile(run, selected)
+        if not os.path.exists(fname):
+            print(f"File {fname} does not exist")
+            continue
+        chans = loadChannels([fname], branch, cache=True)
+        for start in range(0, chans.shape[0], chunksize):
+            yield chans[start:start+chunksize]
+        del chans
+
+
+def getRunChannelsFile(run, selected=False, branch="ch_lg"):
+    """
+    .npy file with the channels of one run, for the readers that should not go
+    through ROOT, e.g. the tf.data threads of CNNRegression. The raw runs use the
+    columnar cache when it is valid, otherwise the channels are written from the
+    ROOT file on first use, and again whenever the ROOT file is newer.
+    Returns None if the run has no file
+    """
+    fname = getRunFile(run, selected)
+    if not os.path.exists(fname):
+        print(f"File {fname} does not exist")
+        return None
+    if not selected and loadRunCache(run, [branch], source=fname) is not None:
+        return getCachePath(run, branch)
+    outname = f"{cachedir}/Run{run}/{branch}_{'selected' if selected else 'root'}.npy"
+    if not os.path.exists(outname) or os.path.getmtime(outname) < os.path.getmtime(fname):
+        print(f"Writing the channels of {fname} to {outname}")
+        os.makedirs(os.path.dirname(outname), exist_ok=True)
+        # np.save adds .npy to names without it
+        tmpname = outname[:-len(".npy")] + ".tmp.npy"
+        np.save(tmpname, loadChannels([fname], branch))
+        os.replace(tmpname, outname)
+    return outname
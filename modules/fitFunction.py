@@ -2,6 +2,7 @@ import numpy as np
 import json
 import ROOT
 from .runinfo import GetEnergy, HasAttenuator, HasFilter, IsMuonRun
+from .binnedFit import fitGaussianBinned
 import os
 
 
@@ -10,147 +11,119 @@ def fitFunction(chans, scales):
     return predictions
 
 
-def saveResults(result, outname="results.json"):
+def saveResults(result, outname="results.json", errors=None):
+    """
+    with errors, the result is saved as {"values": result, "errors": errors}
+    """
+    if errors is not None:
+        result = {"values": result, "errors": errors}
     with open(outname, "w") as f:
         json.dump(result, f)
 
 
-def loadResults(outname="results.json"):
+def loadResults(outname="results.json", withErrors=False):
+    """
+    read the results saved by saveResults, with or without errors.
+    With withErrors, return (values, errors), errors being None if not saved
+    """
     with open(outname, "r") as f:
         result = json.load(f)
+    errors = None
+    if isinstance(result, dict) and "values" in result:
+        errors = result.get("errors")
+        result = result["values"]
+    if withErrors:
+        return result, errors
     return result
 
 
-def runFit(h, suffix, mean=3100.0, xmin=0.0, xmax=7500.0, xfitmin=2950.0, xfitmax=3400.0, be=1.0, hasAtten=False, outdir="plots/fits"):
-    h.GetXaxis().SetRangeUser(xmin, xmax)
-    xmean = h.GetMean()
-    xrms = h.GetRMS()
-    xbins = h.GetNbinsX()
-
-    if hasAtten:
-        atte = 0.33
-    else:
-        atte = 1.0
-
-    print("xmean = ", xmean)
-    print("xrms = ", xrms)
-    print("xbins = ", xbins)
-
-    var = ROOT.RooRealVar("energy_" + suffix, "energy", xmin, xmax, "ADCCount")
-    var.setRange("r1", xfitmin, xfitmax)
-    datahist = ROOT.RooDataHist("datahist_" + suffix, "datahist",
-                                ROOT.RooArgList(var, "argdatahist"), h)
-
+def getHistData(h):
+    """
+    bin edges, contents and errors of a TH1, such that the fitted histogram
+    can be kept (and pickled) without ROOT
+    """
+    nbins = h.GetNbinsX()
+    return {
+        "edges": [h.GetXaxis().GetBinLowEdge(i) for i in range(1, nbins+2)],
+        "contents": [h.GetBinContent(i) for i in range(1, nbins+1)],
+        "errors": [h.GetBinError(i) for i in range(1, nbins+1)],
+    }
+
+
+def makeHist(histdata, name):
+    edges = np.array(histdata["edges"], dtype=np.float64)
+    h = ROOT.TH1D(name, name, len(edges)-1, edges)
+    h.SetDirectory(0)
+    for i, (content, error) in enumerate(zip(histdata["contents"], histdata["errors"])):
+        h.SetBinContent(i+1, content)
+        h.SetBinError(i+1, error)
+    return h
+
+
+def makeGaussianPdf(var, suffix, xmean, xrms):
+    """
+    gaussian pdf of the signal fit, and its parameters by name
+    """
     vmean = ROOT.RooRealVar("vmean_" + suffix, "vmean",
                             xmean, xmean-2*xrms, xmean+2*xrms, "ADCCount")
     vsigma = ROOT.RooRealVar("vsigma_" + suffix, "vsigma",
                              xrms, 0.1, 2*xrms, "ADCCount")
     pdf = ROOT.RooGaussian("pdf_" + suffix, "pdf", var, vmean, vsigma)
+    return pdf, {"mean": vmean, "sigma": vsigma}, []
+
+
+def makeShapeParams(suffix):
+    """
+    tail and background shape parameters of the MIP pdf
+    """
+    return {
+        "alphaL": ROOT.RooRealVar("alphaL_" + suffix, "alphaL", 1.0, 0.0, 10.0),
+        "nL": ROOT.RooRealVar("nL_" + suffix, "nL", 1.0, 0.0, 10.0),
+        "alphaR": ROOT.RooRealVar("alphaR_" + suffix, "alphaR", 1.0, 0.0, 10.0),
+        "nR": ROOT.RooRealVar("nR_" + suffix, "nR", 1.0, 0.0, 10.0),
+        "v0": ROOT.RooRealVar("v0_" + suffix, "v0", -0.0, -10.0, 0.0),
+    }
+
+
+def makeMIPPdf(var, suffix, xmean, xrms, shape=None):
+    """
+    crystal ball + exponential pdf of the MIP fit, its parameters by name,
+    and the components to keep alive.
+    shape are the makeShapeParams to use, e.g. shared between channels, new ones if None
+    """
+    if shape is None:
+        shape = makeShapeParams(suffix)
+    # crystal ball for signal
+    vmean = ROOT.RooRealVar("vmean_" + suffix, "vmean",
+                            xmean, xmean-2*xrms, xmean+2*xrms, "ADCCount")
+    vsigmaL = ROOT.RooRealVar(
+        "vsigmaL_" + suffix, "vsigmaL", xrms, 0.1, 1.5*xrms, "ADCCount")
+    pdf_sig = ROOT.RooCrystalBall(
+        "pdfsig_" + suffix, "pdfsig", var, vmean, vsigmaL, shape["alphaL"], shape["nL"], shape["alphaR"], shape["nR"])
 
-    # run the fit
-    pdf.fitTo(datahist, ROOT.RooFit.Range("r1"))
-
-    # make plots
-    tsize = 0.045
-
-    ROOT.gStyle.SetPadLeftMargin(0.14)
-    ROOT.gStyle.SetPadRightMargin(0.04)
-    c = ROOT.TCanvas("c_" + suffix, "c", 800, 1000)
-    c.SetLeftMargin(0.15)
-    c.SetRightMargin(0.05)
-    padsize1 = 0.67
-    padsize2 = 0.33
-    paddown = ROOT.TPad('bottompad_' + suffix,
-                        'bottompad', 0.0, 0.0, 1, padsize2)
-    padtop = ROOT.TPad('toppad_' + suffix, 'toppad', 0.0, padsize2, 1, 1)
-    padtop.SetTopMargin(0.05*0.667/(padsize1*padsize1))
-    padtop.SetBottomMargin(0.012/padsize1)
-    paddown.SetTopMargin(0.010/padsize2)
-    paddown.SetBottomMargin(0.13/padsize2)
-    paddown.SetGridy(1)
-    c.cd()
-    paddown.Draw()
-    padtop.Draw()
-
-    padtop.cd()
-    padtop.SetLogy()
-    frame = var.frame()
-    frame.GetXaxis().SetTitle("energy [ADCCount]")
-    datahist.plotOn(frame)
-    pdf.plotOn(frame)
-    frame.SetTitle("EMCal Test beam")
-    frame.GetXaxis().SetTitleSize(0.)
-    frame.GetXaxis().SetLabelSize(0.)
-    frame.GetYaxis().SetRangeUser(1.0, datahist.sumEntries())
-    frame.GetYaxis().SetLabelSize(tsize)
-    frame.GetYaxis().SetTitleSize(tsize*1.25)
-    frame.GetYaxis().SetTitleOffset(1.1)
-    frame.Draw()
-
-    chi2 = frame.chiSquare()
-    latex = ROOT.TLatex()
-    latex.SetNDC()
-    latex.SetTextColor(1)
-    latex.SetTextSize(tsize)
-    latex.SetTextFont(42)
-    latex.DrawLatexNDC(0.20, 0.80, "#chi^{2}/ndf = %.2f" % (chi2))
-    latex.DrawLatexNDC(0.20, 0.75, "#mu = %.2f #pm %.2f" %
-                       (vmean.getVal(), vmean.getError()))
-    latex.DrawLatexNDC(0.20, 0.70, "#sigma = %.2f #pm %.2f" %
-                       (vsigma.getVal(), vsigma.getError()))
-    latex.DrawLatexNDC(0.20, 0.65, "#sigma / #mu = %.1f%%" %
-                       (vsigma.getVal()/vmean.getVal()*100.))
-
-    # extra information
-    run = int(suffix.split("_")[1])
-    yval = 0.80
-    xval = 0.70
-    latex.DrawLatexNDC(xval, yval, f"Run {run}")
-    yval -= 0.05
-    latex.DrawLatexNDC(xval, yval, f"E = {GetEnergy(run)} GeV")
-    yval -= 0.05
-    if HasAttenuator(run):
-        latex.DrawLatexNDC(xval, yval, "with attenuator")
-        yval -= 0.05
-    if HasFilter(run):
-        latex.DrawLatexNDC(xval, yval, "with filter")
-        yval -= 0.05
-    if IsMuonRun(run):
-        latex.DrawLatexNDC(xval, yval, "muon run")
-        yval -= 0.05
-    frame.addObject(latex)
-
-    # make pull histograms
-    hpull = frame.pullHist()
-    frame2 = var.frame()
-    frame2.SetTitle("")
-    frame2.addPlotable(hpull, "P")
-    frame2.GetXaxis().SetTitle("Energy [ADCCount]")
-    frame2.GetYaxis().SetTitle("Pull")
-    frame2.GetYaxis().CenterTitle()
-    frame2.GetYaxis().SetNdivisions(505)
-    frame2.GetYaxis().SetLabelSize(tsize*2)
-    frame2.GetYaxis().SetTitleSize(tsize*2.5)
-    frame2.GetYaxis().SetTitleOffset(0.5)
-    frame2.GetXaxis().SetTitleOffset(1.2)
-    frame2.GetXaxis().SetLabelSize(tsize*2)
-    frame2.GetXaxis().SetTitleSize(tsize*2.5)
-
-    paddown.cd()
-    frame2.Draw()
-
-    if not os.path.exists(outdir):
-        os.makedirs(outdir)
+    # exp for bkg
+    pdf_bkg = ROOT.RooExponential(
+        "pdfbkg_" + suffix, "pdfbkg", var, shape["v0"])
 
-    c.SaveAs(f"{outdir}/fit_{suffix}.pdf")
-    c.SaveAs(f"{outdir}/fit_{suffix}.png")
+    frac = ROOT.RooRealVar("frac_" + suffix, "frac", 0.5, 0.0, 1.0)
+    pdf = ROOT.RooAddPdf("pdf_" + suffix, "pdf",
+                         ROOT.RooArgList(pdf_sig, pdf_bkg), ROOT.RooArgList(frac))
+    params = {"mean": vmean, "sigma": vsigmaL, "alphaL": shape["alphaL"], "nL": shape["nL"],
+              "alphaR": shape["alphaR"], "nR": shape["nR"], "v0": shape["v0"], "frac": frac}
+    return pdf, params, [pdf_sig, pdf_bkg]
 
-    print("nevents: ", h.Integral(0, h.GetNbinsX()+1))
 
-    return (vmean.getVal(), vmean.getError()), (vsigma.getVal(), vsigma.getError())
+pdfMakers = {"gaus": makeGaussianPdf, "mip": makeMIPPdf}
 
 
-def runMIPFit(h, suffix, xmin=0.0, xmax=7500.0, xfitmin=2950.0, xfitmax=3400.0, outdir="plots/MIPFits"):
+def runFitOnly(h, suffix, model="gaus", xmin=0.0, xmax=7500.0, xfitmin=2950.0, xfitmax=3400.0, backend="roofit"):
+    """
+    fit h in [xfitmin, xfitmax] with the model "gaus" or "mip", without any plotting.
+    backend is "roofit", or "numpy" for the gaussian (modules/binnedFit.py).
+    Returns a dict of plain python values: values, errors, covariance (in the order of params),
+    status and covQual of the fit, chi2ndf as drawn on the plots, and the histogram and
+    settings needed to draw the fit later with drawFit
+    """
     h.GetXaxis().SetRangeUser(xmin, xmax)
     xmean = h.GetMean()
     xrms = h.GetRMS()
@@ -160,37 +133,131 @@ def runMIPFit(h, suffix, xmin=0.0, xmax=7500.0, xfitmin=2950.0, xfitmax=3400.0,
     print("xrms = ", xrms)
     print("xbins = ", xbins)
 
+    if backend == "numpy":
+        if model != "gaus":
+            raise ValueError(f"The numpy backend only fits gaus, not {model}")
+        return runNumpyFit(h, suffix, xmin, xmax, xfitmin, xfitmax, xmean, xrms)
+    if backend != "roofit":
+        raise ValueError(f"Unknown fit backend {backend}")
+
     var = ROOT.RooRealVar("energy_" + suffix, "energy", xmin, xmax, "ADCCount")
     var.setRange("r1", xfitmin, xfitmax)
     datahist = ROOT.RooDataHist("datahist_" + suffix, "datahist",
                                 ROOT.RooArgList(var, "argdatahist"), h)
+    pdf, params, _ = pdfMakers[model](var, suffix, xmean, xrms)
 
-    # crystal ball for signal
-    vmean = ROOT.RooRealVar("vmean_" + suffix, "vmean",
-                            xmean, xmean-2*xrms, xmean+2*xrms, "ADCCount")
-    vsigmaL = ROOT.RooRealVar(
-        "vsigmaL_" + suffix, "vsigmaL", xrms, 0.1, 1.5*xrms, "ADCCount")
-    vsigmaR = ROOT.RooRealVar(
-        "vsigmaR_" + suffix, "vsigmaR", xrms, 0.1, 2*xrms, "ADCCount")
-    alphaL = ROOT.RooRealVar("alphaL_" + suffix, "alphaL", 1.0, 0.0, 10.0)
-    alphaR = ROOT.RooRealVar("alphaR_" + suffix, "alphaR", 1.0, 0.0, 10.0)
-    nL = ROOT.RooRealVar("nL_" + suffix, "nL", 1.0, 0.0, 10.0)
-    nR = ROOT.RooRealVar("nR_" + suffix, "nR", 1.0, 0.0, 10.0)
-    # pdf_sig = ROOT.RooCrystalBall("pdfsig_" + suffix, "pdfsig",
-    #                              var, vmean, vsigmaL, vsigmaR, alphaL, nL, alphaR, nR)
-    pdf_sig = ROOT.RooCrystalBall(
-        "pdfsig_" + suffix, "pdfsig", var, vmean, vsigmaL, alphaL, nL, alphaR, nR)
+    # run the fit
+    fitresult = pdf.fitTo(datahist, ROOT.RooFit.Range("r1"),
+                          ROOT.RooFit.Save(True))
 
-    # exp for bkg
-    v0 = ROOT.RooRealVar("v0_" + suffix, "v0", -0.0, -10.0, 0.0)
-    pdf_bkg = ROOT.RooExponential("pdfbkg_" + suffix, "pdfbkg", var, v0)
+    # chi2/ndf of the pdf curve in the fit range, the same as on the plots
+    frame = var.frame()
+    datahist.plotOn(frame)
+    pdf.plotOn(frame, ROOT.RooFit.Range("r1"), ROOT.RooFit.NormRange("r1"))
+    chi2ndf = frame.chiSquare()
+
+    # covariance of the floating parameters, in the order of params
+    floating = [p.GetName() for p in fitresult.floatParsFinal()]
+    names = [name for name, p in params.items() if p.GetName() in floating]
+    cov = fitresult.covarianceMatrix()
+    idx = [floating.index(params[name].GetName()) for name in names]
+    covariance = [[cov(i, j) for j in idx] for i in idx]
+
+    nevents = h.Integral(0, h.GetNbinsX()+1)
+    print("nevents: ", nevents)
+
+    return {
+        "suffix": suffix,
+        "model": model,
+        "params": names,
+        "values": {name: params[name].getVal() for name in params},
+        "errors": {name: params[name].getError() for name in params},
+        "covariance": covariance,
+        "status": fitresult.status(),
+        "covQual": fitresult.covQual(),
+        "chi2ndf": chi2ndf,
+        "nevents": nevents,
+        "plotdata": {"hist": getHistData(h), "xmin": xmin, "xmax": xmax,
+                     "xfitmin": xfitmin, "xfitmax": xfitmax, "xmean": xmean, "xrms": xrms},
+    }
+
+
+def runNumpyFit(h, suffix, xmin, xmax, xfitmin, xfitmax, xmean, xrms):
+    """
+    gaussian fit of runFitOnly with the numpy backend, same result format
+    """
+    histdata = getHistData(h)
+    # same parameter ranges as makeGaussianPdf
+    bounds = ((xmean-2*xrms, xmean+2*xrms), (0.1, 2*xrms))
+    fit = fitGaussianBinned(histdata["edges"], histdata["contents"], xmin, xmax,
+                            xfitmin, xfitmax, xmean, xrms, bounds)
+    names = ["mean", "sigma"]
+
+    nevents = h.Integral(0, h.GetNbinsX()+1)
+    print("nevents: ", nevents)
+
+    return {
+        "suffix": suffix,
+        "model": "gaus",
+        "params": names,
+        "values": {name: float(v) for name, v in zip(names, fit["values"])},
+        "errors": {name: float(e) for name, e in zip(names, fit["errors"])},
+        "covariance": fit["covariance"].tolist(),
+        "status": fit["status"],
+        "covQual": fit["covQual"],
+        "chi2ndf": fit["chi2ndf"],
+        "nevents": nevents,
+        "plotdata": {"hist": histdata, "xmin": xmin, "xmax": xmax,
+                     "xfitmin": xfitmin, "xfitmax": xfitmax, "xmean": xmean, "xrms": xrms},
+    }
+
+
+def getRunLabels(suffix):
+    """
+    run range and channel of a fit from its suffix, e.g. cal_123, cal_Run123_Run130_5
+    """
+    def getRunNumber(suffix, isEnd=False):
+        idx = 1 if not isEnd else 2
+        run = suffix.split("_")[idx]
+        if run.startswith("Run"):
+            run = run[3:]
+        return int(run)
 
-    frac = ROOT.RooRealVar("frac_" + suffix, "frac", 0.5, 0.0, 1.0)
-    pdf = ROOT.RooAddPdf("pdf_" + suffix, "pdf",
-                         ROOT.RooArgList(pdf_sig, pdf_bkg), ROOT.RooArgList(frac))
+    run_start = getRunNumber(suffix)
+    runstr = f"Run {run_start}"
 
-    # run the fit
-    pdf.fitTo(datahist, ROOT.RooFit.Range("r1"))
+    chName = None
+    if suffix.count("_") >= 2:
+        run_end = getRunNumber(suffix, isEnd=True)
+        if run_end != run_start:
+            runstr += f" - {run_end}"
+    if suffix.count("_") >= 3:
+        chName = suffix.split("_")[-1]
+    return run_start, runstr, chName
+
+
+def drawFit(result, outdir="plots/fits"):
+    """
+    draw a fit of runFitOnly, with the pulls, to outdir/fit_{suffix}.pdf and png.
+    The histogram and the pdf are rebuilt from the result, so the drawing can be
+    done later, or in another process than the fit
+    """
+    suffix = result["suffix"]
+    isMIP = result["model"] == "mip"
+    plotdata = result["plotdata"]
+    h = makeHist(plotdata["hist"], "hfit_" + suffix)
+    h.GetXaxis().SetRangeUser(plotdata["xmin"], plotdata["xmax"])
+
+    var = ROOT.RooRealVar(
+        "energy_" + suffix, "energy", plotdata["xmin"], plotdata["xmax"], "ADCCount")
+    var.setRange("r1", plotdata["xfitmin"], plotdata["xfitmax"])
+    datahist = ROOT.RooDataHist("datahist_" + suffix, "datahist",
+                                ROOT.RooArgList(var, "argdatahist"), h)
+    pdf, params, components = pdfMakers[result["model"]](
+        var, suffix, plotdata["xmean"], plotdata["xrms"])
+    for name, p in params.items():
+        p.setVal(result["values"][name])
+        p.setError(result["errors"][name])
 
     # make plots
     tsize = 0.045
@@ -219,54 +286,45 @@ def runMIPFit(h, suffix, xmin=0.0, xmax=7500.0, xfitmin=2950.0, xfitmax=3400.0,
     frame = var.frame()
     frame.GetXaxis().SetTitle("energy [ADCCount]")
     datahist.plotOn(frame)
-    pdf.plotOn(frame, ROOT.RooFit.Components("pdfsig_" + suffix),
-               ROOT.RooFit.LineStyle(2), ROOT.RooFit.LineColor(2))
-    pdf.plotOn(frame, ROOT.RooFit.Components("pdfbkg_" + suffix),
-               ROOT.RooFit.LineStyle(2), ROOT.RooFit.LineColor(3))
-    pdf.plotOn(frame, ROOT.RooFit.LineStyle(1), ROOT.RooFit.LineColor(4))
+    # the curve is drawn and normalized in the fit range, as right after the fit
+    fitrange = [ROOT.RooFit.Range("r1"), ROOT.RooFit.NormRange("r1")]
+    if isMIP:
+        pdf.plotOn(frame, ROOT.RooFit.Components("pdfsig_" + suffix),
+                   ROOT.RooFit.LineStyle(2), ROOT.RooFit.LineColor(2), *fitrange)
+        pdf.plotOn(frame, ROOT.RooFit.Components("pdfbkg_" + suffix),
+                   ROOT.RooFit.LineStyle(2), ROOT.RooFit.LineColor(3), *fitrange)
+        pdf.plotOn(frame, ROOT.RooFit.LineStyle(1),
+                   ROOT.RooFit.LineColor(4), *fitrange)
+    else:
+        pdf.plotOn(frame, *fitrange)
     frame.SetTitle("EMCal Test beam")
     frame.GetXaxis().SetTitleSize(0.)
     frame.GetXaxis().SetLabelSize(0.)
-    frame.GetYaxis().SetRangeUser(10.0, 100*datahist.sumEntries())
+    if isMIP:
+        frame.GetYaxis().SetRangeUser(10.0, 100*datahist.sumEntries())
+    else:
+        frame.GetYaxis().SetRangeUser(1.0, datahist.sumEntries())
     frame.GetYaxis().SetLabelSize(tsize)
     frame.GetYaxis().SetTitleSize(tsize*1.25)
     frame.GetYaxis().SetTitleOffset(1.1)
     frame.Draw()
 
-    chi2 = frame.chiSquare()
+    values, errors = result["values"], result["errors"]
     latex = ROOT.TLatex()
     latex.SetNDC()
     latex.SetTextColor(1)
     latex.SetTextSize(tsize)
     latex.SetTextFont(42)
-    latex.DrawLatexNDC(0.20, 0.80, "#chi^{2}/ndf = %.2f" % (chi2))
+    latex.DrawLatexNDC(0.20, 0.80, "#chi^{2}/ndf = %.2f" % (result["chi2ndf"]))
     latex.DrawLatexNDC(0.20, 0.75, "#mu = %.2f #pm %.2f" %
-                       (vmean.getVal(), vmean.getError()))
+                       (values["mean"], errors["mean"]))
     latex.DrawLatexNDC(0.20, 0.70, "#sigma = %.2f #pm %.2f" %
-                       (vsigmaL.getVal(), vsigmaL.getError()))
-    # latex.DrawLatexNDC(0.20, 0.65, "#sigmaR = %.2f #pm %.2f" %
-    #                   (vsigmaR.getVal(), vsigmaR.getError()))
+                       (values["sigma"], errors["sigma"]))
     latex.DrawLatexNDC(0.20, 0.65, "#sigma / #mu = %.1f%%" %
-                       (vsigmaL.getVal()/vmean.getVal()*100.))
+                       (values["sigma"]/values["mean"]*100.))
 
     # extra information
-    def getRunNumber(suffix, isEnd=False):
-        idx = 1 if not isEnd else 2
-        run = suffix.split("_")[idx]
-        if run.startswith("Run"):
-            run = run[3:]
-        return int(run)
-
-    run_start = getRunNumber(suffix)
-    runstr = f"Run {run_start}"
-
-    chName = None
-    if suffix.count("_") >= 2:
-        run_end = getRunNumber(suffix, isEnd=True)
-        if run_end != run_start:
-            runstr += f" - {run_end}"
-    if suffix.count("_") >= 3:
-        chName = suffix.split("_")[-1]
+    run_start, runstr, chName = getRunLabels(suffix)
     yval = 0.80
     xval = 0.70
     latex.DrawLatexNDC(xval, yval, runstr)
@@ -302,17 +360,111 @@ def runMIPFit(h, suffix, xmin=0.0, xmax=7500.0, xfitmin=2950.0, xfitmax=3400.0,
     frame2.GetXaxis().SetTitleOffset(1.2)
     frame2.GetXaxis().SetLabelSize(tsize*2)
     frame2.GetXaxis().SetTitleSize(tsize*2.5)
-    frame2.GetYaxis().SetRangeUser(-4.2, 4.2)
+    if isMIP:
+        frame2.GetYaxis().SetRangeUser(-4.2, 4.2)
 
     paddown.cd()
     frame2.Draw()
 
-    if not os.path.exists(outdir):
-        os.makedirs(outdir)
+    # several pool workers can draw into the same directory at once
+    os.makedirs(outdir, exist_ok=True)
 
     c.SaveAs(f"{outdir}/fit_{suffix}.pdf")
     c.SaveAs(f"{outdir}/fit_{suffix}.png")
 
-    print("nevents: ", h.Integral(0, h.GetNbinsX()+1))
 
-    return (vmean.getVal(), vmean.getError()), (vsigmaL.getVal(), vsigmaL.getError())
+def runFit(h, suffix, mean=3100.0, xmin=0.0, xmax=7500.0, xfitmin=2950.0, xfitmax=3400.0, be=1.0, hasAtten=False, outdir="plots/fits", draw=True, backend="roofit"):
+    """
+    gaussian fit of h with the roofit or numpy backend, drawn to outdir unless draw is False.
+    Returns (mean, error), (sigma, error)
+    """
+    result = runFitOnly(h, suffix, "gaus", xmin=xmin, xmax=xmax,
+                        xfitmin=xfitmin, xfitmax=xfitmax, backend=backend)
+    if draw:
+        drawFit(result, outdir)
+    values, errors = result["values"], result["errors"]
+    return (values["mean"], errors["mean"]), (values["sigma"], errors["sigma"])
+
+
+def runMIPFit(h, suffix, xmin=0.0, xmax=7500.0, xfitmin=2950.0, xfitmax=3400.0, outdir="plots/MIPFits", draw=True):
+    """
+    crystal ball + exponential fit of h, drawn to outdir unless draw is False.
+    Returns (mean, error), (sigma, error) of the crystal ball
+    """
+    result = runFitOnly(h, suffix, "mip", xmin=xmin, xmax=xmax,
+                        xfitmin=xfitmin, xfitmax=xfitmax)
+    if draw:
+        drawFit(result, outdir)
+    values, errors = result["values"], result["errors"]
+    return (values["mean"], errors["mean"]), (values["sigma"], errors["sigma"])
+
+
+def runSimultaneousMIPFit(histos, suffix, xmin=0.0, xmax=7500.0, xfitmin=2950.0, xfitmax=3400.0, ncpu=1):
+    """
+    simultaneous MIP fit of the histograms of all the channels, with RooSimultaneous:
+    the tail and background shape parameters are shared, mean, sigma and the signal
+    fraction are per channel. The likelihood is evaluated on ncpu processes.
+    Returns one result per channel, in the format of runFitOnly (suffix {suffix}_{ch}),
+    with the status of the common fit
+    """
+    var = ROOT.RooRealVar("energy_" + suffix, "energy", xmin, xmax, "ADCCount")
+    var.setRange("r1", xfitmin, xfitmax)
+    cat = ROOT.RooCategory("channel_" + suffix, "channel")
+    shape = makeShapeParams(suffix)
+    simpdf = ROOT.RooSimultaneous("simpdf_" + suffix, "simpdf", cat)
+
+    channels = []
+    histmap = ROOT.std.map("std::string, TH1*")()
+    for ch, h in enumerate(histos):
+        chsuffix = f"{suffix}_{ch}"
+        h.GetXaxis().SetRangeUser(xmin, xmax)
+        xmean = h.GetMean()
+        xrms = h.GetRMS()
+        pdf, params, components = makeMIPPdf(var, chsuffix, xmean, xrms, shape)
+        cat.defineType(chsuffix, ch)
+        simpdf.addPdf(pdf, chsuffix)
+        histmap[chsuffix] = h
+        channels.append({"suffix": chsuffix, "hist": h, "pdf": pdf, "params": params,
+                         "components": components, "xmean": xmean, "xrms": xrms})
+
+    datahist = ROOT.RooDataHist("datahist_" + suffix, "datahist",
+                                ROOT.RooArgList(var), cat, histmap)
+
+    # run the fit
+    fitresult = simpdf.fitTo(datahist, ROOT.RooFit.Range("r1"), ROOT.RooFit.Save(True),
+                             ROOT.RooFit.NumCPU(ncpu))
+    floating = [p.GetName() for p in fitresult.floatParsFinal()]
+    cov = fitresult.covarianceMatrix()
+
+    results = []
+    for channel in channels:
+        chsuffix, h, pdf, params = channel["suffix"], channel["hist"], channel["pdf"], channel["params"]
+
+        # chi2/ndf of the channel, the same as on the plots
+        chdatahist = ROOT.RooDataHist("datahist_" + chsuffix, "datahist",
+                                      ROOT.RooArgList(var, "argdatahist"), h)
+        frame = var.frame()
+        chdatahist.plotOn(frame)
+        pdf.plotOn(frame, ROOT.RooFit.Range("r1"), ROOT.RooFit.NormRange("r1"))
+        chi2ndf = frame.chiSquare()
+
+        names = [name for name, p in params.items()
+                 if p.GetName() in floating]
+        idx = [floating.index(params[name].GetName()) for name in names]
+        nevents = h.Integral(0, h.GetNbinsX()+1)
+        results.append({
+            "suffix": chsuffix,
+            "model": "mip",
+            "params": names,
+            "values": {name: params[name].getVal() for name in params},
+            "errors": {name: params[name].getError() for name in params},
+            "covariance": [[cov(i, j) for j in idx] for i in idx],
+            "status": fitresult.status(),
+            "covQual": fitresult.covQual(),
+            "chi2ndf": chi2ndf,
+            "nevents": nevents,
+            "plotdata": {"hist": getHistData(h), "xmin": xmin, "xmax": xmax,
+                         "xfitmin": xfitmin, "xfitmax": xfitmax,
+                         "xmean": channel["xmean"], "xrms": channel["xrms"]},
+        })
+    return results
@@ -0,0 +1,105 @@
+# channel geometry of the calorimeter prototype, as precomputed numpy lookup tables.
+# The default is the 4x4 prototype; an alternative channel map can be loaded from a json config
+# given by the EMCAL_GEOMETRY environment variable, e.g.
+# {"nx": 4, "ny": 4, "channels": {"15": [0, 0], "14": [1, 0], ...}}
+# Only the position of the channels can change: the list parser, the cache, the
+# histograms and the CNN are made for 16 channels on a 4x4 grid
+import os
+import json
+import numpy as np
+
+# channel: (x, y) of the 4x4 prototype
+default_layout = {
+    15: (0, 0),
+    14: (1, 0),
+    13: (0, 1),
+    12: (1, 1),
+    11: (2, 0),
+    10: (3, 0),
+    9: (2, 1),
+    8: (3, 1),
+    7: (0, 2),
+    6: (1, 2),
+    5: (0, 3),
+    4: (1, 3),
+    3: (2, 2),
+    2: (3, 2),
+    1: (2, 3),
+    0: (3, 3)
+}
+
+
+def makeGeometry(layout, nx, ny):
+    """
+    build the lookup tables of a layout {channel: (x, y)}:
+    chan_xy: list of the (x, y) of each channel
+    chan_x, chan_y: position of each channel
+    xy_to_chan: (nx, ny) array of the channel at each position, -1 if empty
+    flat_perm: permutation such that chans[:, flat_perm].reshape(-1, nx, ny, 1)
+               puts each channel at its (x, y), for a fully populated grid
+    """
+    nchannels = len(layout)
+    if sorted(layout.keys()) != list(range(nchannels)):
+        raise ValueError(
+            f"Channels of the layout should be 0 to {nchannels-1}, got {sorted(layout.keys())}")
+    chan_x = np.array([layout[ch][0] for ch in range(nchannels)])
+    chan_y = np.array([layout[ch][1] for ch in range(nchannels)])
+    if chan_x.min() < 0 or chan_x.max() >= nx or chan_y.min() < 0 or chan_y.max() >= ny:
+        raise ValueError(f"Channel positions outside of the {nx}x{ny} grid")
+    xy_to_chan = np.full((nx, ny), -1)
+    xy_to_chan[chan_x, chan_y] = np.arange(nchannels)
+    if np.count_nonzero(xy_to_chan >= 0) != nchannels:
+        raise ValueError("Several channels at the same position")
+
+    return {
+        "nx": nx,
+        "ny": ny,
+        "nchannels": nchannels,
+        "chan_xy": [(int(x), int(y)) for x, y in zip(chan_x, chan_y)],
+        "chan_x": chan_x,
+        "chan_y": chan_y,
+        "xy_to_chan": xy_to_chan,
+        "flat_perm": xy_to_chan.ravel() if nchannels == nx * ny else None,
+    }
+
+
+def loadGeometry(fname):
+    with open(fname, "r") as f:
+        config = json.load(f)
+    layout = {int(ch): tuple(xy) for ch, xy in config["channels"].items()}
+    if (config["nx"], config["ny"], len(layout)) != (4, 4, 16):
+        raise ValueError(
+            f"Only 16 channels on a 4x4 grid are supported, got {len(layout)} channels on {config['nx']}x{config['ny']} in {fname}")
+    return makeGeometry(layout, config["nx"], config["ny"])
+
+
+if os.getenv("EMCAL_GEOMETRY"):
+    geometry = loadGeometry(os.getenv("EMCAL_GEOMETRY"))
+else:
+    geometry = makeGeometry(default_layout, 4, 4)
+
+
+def getGeometry():
+    return geometry
+
+
+def toGrid(chans):
+    """
+    remap (nevents, nchannels) to the (nevents, nx, ny, 1) layout used by the CNN.
+    Empty positions are filled with 0
+    """
+    chans = np.asarray(chans)
+    if geometry["flat_perm"] is not None:
+        return np.ascontiguousarray(chans[:, geometry["flat_perm"]], dtype=np.float32).reshape(
+            chans.shape[0], geometry["nx"], geometry["ny"], 1)
+    grid = np.zeros(
+        (chans.shape[0], geometry["nx"], geometry["ny"], 1), dtype=np.float32)
+    grid[:, geometry["chan_x"], geometry["chan_y"], 0] = chans
+    return grid
+
+
+def fromGrid(grid):
+    """
+    inverse of toGrid, (nevents, nx, ny, 1) to (nevents, nchannels)
+    """
+    return grid[:, geometry["chan_x"], geometry["chan_y"], 0]
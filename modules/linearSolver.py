@@ -0,0 +1,175 @@
+# solvers for the L1 linear regression of the channel scales.
+# With only 16 scales, everything is done on the 16x16 weighted Gram matrix
+# X^T W X and the vector X^T W y, accumulated in one pass over the events,
+# instead of minimizing over all the events with numerical gradients.
+import numpy as np
+from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
+from scipy.linalg import cholesky, solve_triangular
+from scipy.optimize import nnls, minimize, OptimizeResult
+
+# number of events converted to float64 at a time
+chunksize = 1 << 20
+
+
+def getGramStats(chans, target, weights=None):
+    """
+    X^T W X, X^T W y and sum(W) of the events, with W the per-event weights (default 1)
+    """
+    nch = chans.shape[1]
+    gram = np.zeros((nch, nch))
+    xty = np.zeros(nch)
+    sumw = 0.0
+    for start in range(0, chans.shape[0], chunksize):
+        xt = np.asarray(chans[start:start+chunksize], dtype=np.float64).T
+        if weights is None:
+            w = np.ones(xt.shape[1])
+        else:
+            w = np.asarray(weights[start:start+chunksize], dtype=np.float64)
+        gram += (xt * w) @ xt.T
+        xty += (xt @ w) * target
+        sumw += w.sum()
+    return gram, xty, sumw
+
+
+def solveNNLS(gram, xty):
+    """
+    non-negative least squares min |Xw - y|^2, w >= 0, from the Gram statistics.
+    With gram = L L^T, this is min |L^T w - L^-1 X^T y|^2
+    """
+    nch = gram.shape[0]
+    # tiny ridge, for the channels without any signal
+    ridge = 1e-12 * max(np.trace(gram) / nch, 1e-300)
+    L = cholesky(gram + ridge * np.eye(nch), lower=True)
+    rhs = solve_triangular(L, xty, lower=True)
+    w, _ = nnls(L.T, rhs)
+    return w
+
+
+def solveL1IRLS(chans, target, x0=None, weights=None, maxiter=100, tol=1e-6):
+    """
+    min sum |Xw - target|, w >= 0, with iteratively reweighted least squares:
+    each iteration is a weighted NNLS with weights 1/|residual|.
+    weights are optional per-event weights (e.g. 0/1 for a selection) on top of that
+    """
+    return solveL1IRLSStream(lambda: iter([chans]), target, x0=x0,
+                             weights=None if weights is None else [weights],
+                             maxiter=maxiter, tol=tol)
+
+
+def solveL1IRLSStream(chunks, target, x0=None, weights=None, maxiter=100, tol=1e-6):
+    """
+    same as solveL1IRLS, for events that do not fit in memory:
+    chunks() returns a new iterator over the (nevents, nchannels) chunks of events,
+    and weights is the list of the per-event weights of each chunk.
+    Each iteration is one pass over the chunks, only the Gram statistics are kept.
+    The objective of the current scales is computed in the same pass, and the
+    iterations stop once it decreases by less than tol (relative)
+    """
+    eps = 1e-6 * max(abs(target), 1.0)
+    w = None if x0 is None else np.asarray(x0[:-1], dtype=np.float64)
+    if w is None:
+        # start from the least squares solution
+        gram, xty = 0.0, 0.0
+        for i, x in enumerate(chunks()):
+            g, b, _ = getGramStats(x, target, None if weights is None else weights[i])
+            gram, xty = gram + g, xty + b
+        w = solveNNLS(gram, xty)
+
+    best, fbest = w, np.inf
+    success = False
+    message = "maximum number of iterations reached"
+    for it in range(1, maxiter+1):
+        gram, xty, fun = 0.0, 0.0, 0.0
+        for i, x in enumerate(chunks()):
+            res = np.abs(x @ w - target)
+            irls = 1.0 / np.maximum(res, eps)
+            if weights is not None:
+                res *= weights[i]
+                irls *= weights[i]
+            fun += res.sum()
+            g, b, _ = getGramStats(x, target, irls)
+            gram, xty = gram + g, xty + b
+        improvement = fbest - fun
+        if improvement < 0:
+            # each iteration should not increase the objective, the iterations
+            # oscillate (e.g. residuals below eps): stop at the best scales
+            message = "objective increased, stopped at the best iteration"
+            break
+        best, fbest = w, fun
+        if improvement <= tol * fun:
+            success = True
+            message = "converged"
+            break
+        w = solveNNLS(gram, xty)
+
+    if not success:
+        print(f"Warning: IRLS did not converge after {it} iterations ({message}), "
+              f"last relative change of the objective {improvement / max(fbest, 1e-300):.3g}")
+    # the last parameter is the offset, which is not used by fitFunction
+    return OptimizeResult(x=np.append(best, 1.0), fun=float(fbest), nit=it, success=success,
+                          message=message)
+
+
+def solveL1Minimize(chans, target, x0=None, weights=None):
+    """
+    same problem with scipy.optimize.minimize (L-BFGS-B), with the analytic gradient
+    """
+    nch = chans.shape[1]
+    x = np.asarray(chans, dtype=np.float64)
+    if x0 is None:
+        x0 = np.ones(nch)
+
+    def objective(params):
+        res = x @ params - target
+        sign = np.sign(res)
+        if weights is not None:
+            res = res * weights
+            sign = sign * weights
+        return np.sum(np.abs(res)), x.T @ sign
+
+    result = minimize(objective, np.asarray(x0[:nch], dtype=np.float64), jac=True,
+                      bounds=[(0, None)] * nch, method="L-BFGS-B")
+    result.x = np.append(result.x, 1.0)
+    return result
+
+
+# events and fit settings of the bootstrap workers, set by _initBootstrap
+_bootstrap = {}
+
+
+def _initBootstrap(name, shape, dtype, target, x0):
+    shm = SharedMemory(name=name)
+    _bootstrap["shm"] = shm
+    _bootstrap["chans"] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    _bootstrap["target"] = target
+    _bootstrap["x0"] = x0
+
+
+def _bootstrapFit(seed):
+    chans = _bootstrap["chans"]
+    nentries = chans.shape[0]
+    rng = np.random.default_rng(seed)
+    # resampling with replacement, as the number of times each event is drawn
+    counts = np.bincount(rng.integers(0, nentries, nentries), minlength=nentries)
+    return solveL1IRLS(chans, _bootstrap["target"], x0=_bootstrap["x0"], weights=counts).x
+
+
+def bootstrapL1IRLS(chans, target, x0=None, nboot=100, njobs=4, seed=0):
+    """
+    refit solveL1IRLS on nboot resamples of the events, in a pool of njobs processes.
+    The events are shared with the workers through shared memory instead of being pickled.
+    Returns the (nboot, nparams) array of the fitted parameters
+    """
+    chans = np.ascontiguousarray(chans)
+    shm = SharedMemory(create=True, size=max(chans.nbytes, 1))
+    try:
+        np.ndarray(chans.shape, dtype=chans.dtype, buffer=shm.buf)[:] = chans
+        seeds = np.random.SeedSequence(seed).spawn(nboot)
+        with Pool(njobs, initializer=_initBootstrap,
+                  initargs=(shm.name, chans.shape, chans.dtype.str, target, x0)) as p:
+            results = p.map(_bootstrapFit, seeds)
+    finally:
+        shm.close()
+        shm.unlink()
+    return np.array(results)
@@ -0,0 +1,178 @@
+# parse the Janus list files (Run{run}_list.txt) in large blocks with numpy,
+# instead of splitting the file line by line in python
+import time
+import numpy as np
+
+nchannels = 16
+# default number of bytes read from the list file per block
+blocksize = 64 * 1024 * 1024
+
+# characters that can appear in the data lines
+_numeric = b"0123456789.-+eE \t\r\n"
+
+
+def emptyEvents(nch=nchannels):
+    return {
+        "trigID": np.zeros(0, dtype=np.int32),
+        "trigTime": np.zeros(0, dtype=np.float64),
+        "ch_lg": np.zeros((0, nch), dtype=np.int32),
+        "ch_hg": np.zeros((0, nch), dtype=np.int32),
+    }
+
+
+def parseListBlock(buf, final=False, nch=nchannels):
+    """
+    tokenize one block of the list file at once.
+    The event header line has 7 columns (board, channel, lg, hg, tstamp, trigID, nhits),
+    the following channel lines have 4 columns (board, channel, lg, hg). Comment and
+    'Tstamp' header lines are skipped and '-' (no value) is converted to 0.
+
+    Unless final is True, the last event in the block is kept back as it can be
+    incomplete. Returns the events as numpy arrays and the number of bytes consumed.
+    """
+    data = np.frombuffer(buf, dtype=np.uint8)
+    if not final:
+        # only look at complete lines
+        data = data[:buf.rfind(b"\n") + 1]
+    if len(data) == 0:
+        return emptyEvents(nch), 0
+
+    linestart = np.concatenate(([0], np.flatnonzero(data == ord("\n")) + 1))
+    linestart = linestart[linestart < len(data)]
+    lineend = np.append(linestart[1:], len(data))
+
+    text = data
+    # lines with non-numeric characters are comments or column headers
+    if len(buf.translate(None, _numeric)):
+        text = data.copy()
+        notnumeric = np.ones(256, dtype=bool)
+        notnumeric[list(_numeric)] = False
+        badline = np.add.reduceat(
+            notnumeric[data], linestart, dtype=np.int64) > 0
+        for i in np.flatnonzero(badline):
+            line = text[linestart[i]:lineend[i]]
+            line[line != ord("\n")] = ord(" ")
+    # '-' means no value
+    isdash = text == ord("-")
+    if isdash.any():
+        isdash[1:] &= text[:-1] <= ord(" ")
+        isdash[:-1] &= text[1:] <= ord(" ")
+        if text is data:
+            text = data.copy()
+        text[isdash] = ord("0")
+
+    notspace = text > ord(" ")
+    tokstart = notspace.copy()
+    tokstart[1:] &= ~notspace[:-1]
+    ntoks = np.add.reduceat(tokstart, linestart, dtype=np.int64)
+
+    isevent = ntoks == 7
+    ischan = (ntoks == 4) | isevent
+
+    nconsumed = len(data)
+    if not final:
+        evlines = np.flatnonzero(isevent)
+        if len(evlines) == 0:
+            # no event boundary yet; only drop the lines without data
+            if ischan.any():
+                return emptyEvents(nch), 0
+            return emptyEvents(nch), nconsumed
+        # keep the last event for the next block
+        lastline = evlines[-1]
+        nconsumed = linestart[lastline]
+        ntoks[lastline:] = 0
+        isevent[lastline:] = False
+        ischan[lastline:] = False
+
+    if not ischan.any():
+        return emptyEvents(nch), nconsumed
+
+    # convert all the columns at once
+    values = np.fromstring(
+        text[:nconsumed].tobytes(), dtype=np.float64, sep=" ")
+    if len(values) != ntoks.sum():
+        raise ValueError(
+            f"Failed to parse list block: {len(values)} values for {ntoks.sum()} columns")
+
+    # index of the first value of each line
+    firsttok = np.cumsum(ntoks) - ntoks
+
+    evtidx = np.cumsum(isevent) - 1
+    chlines = np.flatnonzero(ischan & (evtidx >= 0))
+    evt = evtidx[chlines]
+    ch = values[firsttok[chlines] + 1].astype(np.int64)
+    valid = (ch >= 0) & (ch < nch)
+    chlines, evt, ch = chlines[valid], evt[valid], ch[valid]
+
+    nev = np.count_nonzero(isevent)
+    occupancy = np.bincount(evt * nch + ch, minlength=nev * nch)
+    complete = (occupancy.reshape(nev, nch) == 1).all(axis=1)
+
+    ch_lg = np.zeros((nev, nch), dtype=np.int32)
+    ch_hg = np.zeros((nev, nch), dtype=np.int32)
+    ch_lg[evt, ch] = values[firsttok[chlines] + 2]
+    ch_hg[evt, ch] = values[firsttok[chlines] + 3]
+
+    evlines = np.flatnonzero(isevent)
+    events = {
+        "trigID": values[firsttok[evlines] + 5].astype(np.int32)[complete],
+        "trigTime": values[firsttok[evlines] + 4][complete],
+        "ch_lg": ch_lg[complete],
+        "ch_hg": ch_hg[complete],
+    }
+    return events, nconsumed
+
+
+def readListBlocks(fname, offset=0, size=blocksize, nch=nchannels):
+    """
+    generator over the list file, yielding the parsed events of each block
+    together with the byte offset in the file up to which events have been parsed
+    """
+    with open(fname, "rb") as infile:
+        infile.seek(offset)
+        leftover = b""
+        while True:
+            chunk = infile.read(size)
+            final = len(chunk) == 0
+            buf = leftover + chunk
+            if len(buf) == 0:
+                break
+            events, nconsumed = parseListBlock(buf, final=final, nch=nch)
+            offset += nconsumed
+            leftover = buf[nconsumed:]
+            if len(events["trigID"]):
+                yield events, offset
+            if final:
+                break
+
+
+def followListBlocks(fname, offset=0, size=blocksize, nch=nchannels, interval=10, timeout=600):
+    """
+    same as readListBlocks, but for a list file that is still being written.
+    New data is polled every interval seconds, and the last event is only parsed
+    once the file has not grown for timeout seconds, i.e. the run has stopped
+    """
+    with open(fname, "rb") as infile:
+        infile.seek(offset)
+        leftover = b""
+        lastupdate = time.time()
+        while True:
+            chunk = infile.read(size)
+            if len(chunk) == 0:
+                if time.time() - lastupdate < timeout:
+                    time.sleep(interval)
+                    continue
+                # the run has stopped
+                print(f"No new data in {fname} for {timeout} seconds")
+                events, nconsumed = parseListBlock(
+                    leftover, final=True, nch=nch)
+                if len(events["trigID"]):
+                    yield events, offset + nconsumed
+                break
+            lastupdate = time.time()
+            buf = leftover + chunk
+            events, nconsumed = parseListBlock(buf, final=False, nch=nch)
+            offset += nconsumed
+            leftover = buf[nconsumed:]
+            if len(events["trigID"]):
+                yield events, offset
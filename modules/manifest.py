@@ -0,0 +1,98 @@
+# lightweight build manifests: for each output, record the inputs (size, mtime and hash),
+# the code version and the parameters it was made with, such that the pipeline stages
+# can skip the runs whose inputs have not changed
+import os
+import json
+import hashlib
+
+manifestdir = "manifests"
+
+
+def getManifestFile(output):
+    return f"{manifestdir}/{os.path.normpath(output)}.json"
+
+
+def hashFile(fname):
+    h = hashlib.sha1()
+    with open(fname, "rb") as f:
+        for chunk in iter(lambda: f.read(16 * 1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def getFileSignature(fname):
+    stat = os.stat(fname)
+    return {"size": stat.st_size, "mtime": stat.st_mtime_ns, "sha1": hashFile(fname)}
+
+
+def getCodeVersion(files):
+    """
+    hash of the source files of a stage
+    """
+    h = hashlib.sha1()
+    for fname in files:
+        h.update(hashFile(fname).encode())
+    return h.hexdigest()
+
+
+def sameFile(fname, signature):
+    if not os.path.exists(fname):
+        return False
+    stat = os.stat(fname)
+    if stat.st_size != signature["size"]:
+        return False
+    if stat.st_mtime_ns == signature["mtime"]:
+        return True
+    # touched, check if the content has changed
+    return hashFile(fname) == signature["sha1"]
+
+
+def isUpToDate(output, inputs, params, code):
+    """
+    check if output exists and was made from the same inputs, parameters and code
+    """
+    fmanifest = getManifestFile(output)
+    if not os.path.exists(output) or not os.path.exists(fmanifest):
+        return False
+    with open(fmanifest, "r") as f:
+        manifest = json.load(f)
+    # compare the parameters the same way they are stored
+    if manifest["params"] != json.loads(json.dumps(params)):
+        return False
+    if manifest["code"] != getCodeVersion(code):
+        return False
+    if sorted(manifest["inputs"].keys()) != sorted(inputs):
+        return False
+    return all(sameFile(fname, manifest["inputs"][fname]) for fname in inputs)
+
+
+def recordManifest(output, inputs, params, code, extra=None):
+    """
+    save the manifest of output, after it has been successfully made
+    """
+    manifest = {
+        "inputs": {fname: getFileSignature(fname) for fname in inputs},
+        "params": params,
+        "code": getCodeVersion(code),
+    }
+    if extra is not None:
+        manifest["extra"] = extra
+    fmanifest = getManifestFile(output)
+    os.makedirs(os.path.dirname(fmanifest), exist_ok=True)
+    with open(fmanifest + ".tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(fmanifest + ".tmp", fmanifest)
+
+
+def loadManifestExtra(output):
+    with open(getManifestFile(output), "r") as f:
+        return json.load(f).get("extra")
+
+
+def parseForce():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--force", action="store_true",
+                        help="rerun all the runs, even if their inputs have not changed")
+    args, unknown = parser.parse_known_args()
+    return args.force
@@ -467,7 +467,8 @@ def DrawHistos(myhistos, mylabels, xmin, xmax, xlabel, ymin, ymax, ylabel, outpu
     dirpath = outputname.rpartition('/')[0]
     if not os.path.exists(dirpath):
         print(f"Make the directory {dirpath}")
-        os.makedirs(dirpath)
+        # exist_ok as the runs can be plotted by several processes at once
+        os.makedirs(dirpath, exist_ok=True)
 
     if savepdf:
         # print("save plot to %s.pdf" % outputname)
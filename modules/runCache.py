@@ -0,0 +1,127 @@
+# columnar numpy cache of the raw runs, written by makeROOT.py next to the ROOT files.
+# each column is saved as cache/Run{run}/{column}.npy, which can be memory-mapped
+# without going through the PyROOT event loop
+import os
+import shutil
+import numpy as np
+
+cachedir = "cache"
+
+# column: (dtype, shape per event)
+columns = {
+    "trigID": (np.int32, ()),
+    "trigTime": (np.float64, ()),
+    "ch_lg": (np.uint16, (16,)),
+    "ch_hg": (np.uint16, (16,)),
+}
+
+
+def getCachePath(run, column, outdir=cachedir):
+    return f"{outdir}/Run{run}/{column}.npy"
+
+
+def hasRunCache(run, outdir=cachedir):
+    return all(os.path.exists(getCachePath(run, column, outdir)) for column in columns)
+
+
+def appendRunCache(run, events, outdir=cachedir):
+    """
+    append a block of parsed events to the raw .part files of the run.
+    Call finalizeRunCache once all the blocks are written.
+    """
+    os.makedirs(f"{outdir}/Run{run}", exist_ok=True)
+    for column, (dtype, _) in columns.items():
+        values = events[column]
+        if np.issubdtype(dtype, np.integer):
+            info = np.iinfo(dtype)
+            values = np.clip(values, info.min, info.max)
+        with open(getCachePath(run, column, outdir) + ".part", "ab") as f:
+            f.write(np.ascontiguousarray(values, dtype=dtype).tobytes())
+
+
+def removeRunCache(run, outdir=cachedir):
+    """
+    remove the cache of the run, finished or not, e.g. when its ROOT file is rewritten
+    """
+    for column in columns:
+        fname = getCachePath(run, column, outdir)
+        for f in [fname, fname + ".part", fname + ".tmp"]:
+            if os.path.exists(f):
+                os.remove(f)
+
+
+def clearRunCache(run, outdir=cachedir):
+    """
+    start a new cache for the run: the old cache is removed and the .part files
+    are created empty, such that a run without any event gives empty arrays
+    """
+    removeRunCache(run, outdir)
+    os.makedirs(f"{outdir}/Run{run}", exist_ok=True)
+    for column in columns:
+        open(getCachePath(run, column, outdir) + ".part", "wb").close()
+
+
+def truncateRunCache(run, nevents, outdir=cachedir):
+    """
+    drop the events after the first nevents from the .part files,
+    e.g. the ones written after the last checkpoint of an interrupted conversion.
+    returns False if the .part files have fewer events
+    """
+    for column, (dtype, shape) in columns.items():
+        fname = getCachePath(run, column, outdir) + ".part"
+        rowsize = np.dtype(dtype).itemsize * int(np.prod(shape, dtype=np.int64))
+        if not os.path.exists(fname) or os.path.getsize(fname) < nevents * rowsize:
+            return False
+        with open(fname, "r+b") as f:
+            f.truncate(nevents * rowsize)
+    return True
+
+
+def finalizeRunCache(run, outdir=cachedir):
+    """
+    turn the .part files into .npy files, by prepending the npy header.
+    The files are renamed at the end such that a partially written cache is never picked up
+    """
+    for column, (dtype, shape) in columns.items():
+        fname = getCachePath(run, column, outdir)
+        rowsize = np.dtype(dtype).itemsize * int(np.prod(shape, dtype=np.int64))
+        nrows = os.path.getsize(fname + ".part") // rowsize
+        header = {
+            "descr": np.lib.format.dtype_to_descr(np.dtype(dtype)),
+            "fortran_order": False,
+            "shape": (nrows,) + shape,
+        }
+        with open(fname + ".tmp", "wb") as fout, open(fname + ".part", "rb") as fin:
+            np.lib.format.write_array_header_1_0(fout, header)
+            shutil.copyfileobj(fin, fout)
+        os.replace(fname + ".tmp", fname)
+        os.remove(fname + ".part")
+
+
+def isRunCacheStale(run, fname, outdir=cachedir):
+    """
+    the cache is written after the ROOT file fname, so a ROOT file newer than
+    the cache was rewritten without updating the cache
+    """
+    if not os.path.exists(fname):
+        return False
+    mtime = os.path.getmtime(fname)
+    return any(os.path.getmtime(getCachePath(run, column, outdir)) < mtime for column in columns)
+
+
+def loadRunCache(run, names=None, outdir=cachedir, mmap=True, source=None):
+    """
+    load the cached columns of one run. With mmap=True the arrays are read-only
+    views on the files and nothing is read until they are accessed.
+    source is the ROOT file of the run, the cache is not used if it is older.
+    returns None if the run is not cached
+    """
+    if not hasRunCache(run, outdir):
+        return None
+    if source is not None and isRunCacheStale(run, source, outdir):
+        print(f"Cache of Run {run} is older than {source}, not using it")
+        return None
+    if names is None:
+        names = list(columns.keys())
+    mode = "r" if mmap else None
+    return {column: np.load(getCachePath(run, column, outdir), mmap_mode=mode) for column in names}
@@ -1,15 +1,133 @@
 # collection for all the functions that are used in the main script
 import sys
 import os
+import json
 from collections import OrderedDict
 from .runinfo import runinfo, GetFitRange, GetEnergy, GetTitle
 from .plotStyles import DrawHistos
+from .geometry import geometry
 import ROOT
 
+# index of each element of the channel arrays, such that a single
+# histogram weighted by ch_lg gives the per-channel sums
+ROOT.gInterpreter.Declare("""
+template <typename T>
+ROOT::VecOps::RVec<int> emcalChannelIndex(const ROOT::VecOps::RVec<T> &v)
+{
+    ROOT::VecOps::RVec<int> idx(v.size());
+    std::iota(idx.begin(), idx.end(), 0);
+    return idx;
+}
+""")
+
+# layout versions of the 'save' tree written by makeROOT.py
+# 1: ch_lg and ch_hg as std::vector<int>
+# 2: ch_lg and ch_hg as fixed-size ch_lg[16]/s arrays
+schema_vector = 1
+schema_array = 2
+
+
+def getSchemaVersion(t):
+    """
+    layout of the ch_lg and ch_hg branches, works for both TTree and TChain.
+    Read from the schema_version marker, or detected from the branch type
+    for the files written before the marker
+    """
+    t.LoadTree(0)
+    fin = t.GetTree().GetCurrentFile() if t.GetTree() else None
+    marker = fin.Get("schema_version") if fin else None
+    if marker:
+        return int(marker.GetTitle())
+    br = t.GetBranch("ch_lg")
+    if br and br.GetClassName().startswith("vector"):
+        return schema_vector
+    return schema_array
+
+
+def writeSchemaVersion(fout, version):
+    """
+    save the layout version as a marker next to the tree
+    """
+    fout.cd()
+    ROOT.TNamed("schema_version", str(version)).Write("", ROOT.TObject.kOverwrite)
+
+
+def getADCSumExpr(t):
+    """
+    RDataFrame expression of the sum of ch_lg.
+    The fixed-size arrays are unsigned short, accumulate into int to avoid overflow
+    """
+    if getSchemaVersion(t) == schema_vector:
+        return "Sum(ch_lg)"
+    return "std::accumulate(ch_lg.begin(), ch_lg.end(), 0)"
+
+
+def getCheckpointFile(run):
+    """
+    checkpoint of the conversion of a run by makeROOT.py,
+    with the byte offset in the list file and the number of events written so far
+    """
+    return f"root/Run{run}_list.checkpoint.json"
+
+
+def saveCheckpoint(fname, checkpoint):
+    with open(fname + ".tmp", "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(fname + ".tmp", fname)
+
+
+def loadCheckpoint(fname):
+    if not os.path.exists(fname):
+        return None
+    with open(fname, "r") as f:
+        return json.load(f)
 
-def plotChSum(t, run, xmin=0, xmax=8000, outdir="plots/ChSum", extraToDraws=[]):
-    h = ROOT.TH1F(f"h_Run{run}ChSum", "h", 500, xmin, xmax)
-    t.Draw(f"Sum$(ch_lg)>>h_Run{run}ChSum")
+
+def getEventCount(run):
+    """
+    number of events converted for the run, also while the conversion is still running.
+    returns None if the run has not been converted
+    """
+    checkpoint = loadCheckpoint(getCheckpointFile(run))
+    if checkpoint is not None:
+        return checkpoint["nevents"]
+    fname = f"root/Run{run}_list.root"
+    if not os.path.exists(fname):
+        return None
+    f = ROOT.TFile(fname)
+    t = f.Get("save")
+    nentries = t.GetEntries() if t else None
+    f.Close()
+    return nentries
+
+
+def getRunDataFrame(t):
+    """
+    RDataFrame of the 'save' tree with the sum of ch_lg defined as ADCSum.
+    The histograms booked on it with the book* functions, and e.g. a lazy Snapshot of the
+    selected events, are all produced in one event loop, triggered by the first GetValue
+    """
+    return ROOT.RDataFrame(t).Define("ADCSum", getADCSumExpr(t))
+
+
+def applyFitRangeSel(rdf, run, xmin=None, xmax=None):
+    energy = GetEnergy(run)
+    _, atte, hasfilter, _ = runinfo[run]
+    _, _, fitmin, fitmax = GetFitRange(energy, atte, hasfilter)
+    if xmin is not None:
+        fitmin = xmin
+    if xmax is not None:
+        fitmax = xmax
+    # fitmin and fitmax are basically the electron dominated region
+    return rdf.Filter(f"ADCSum > {fitmin}").Filter(f'ADCSum < {fitmax}')
+
+
+def bookChSum(rdf, run, xmin=0, xmax=8000):
+    return rdf.Histo1D((f"h_Run{run}ChSum", "h", 500, xmin, xmax), "ADCSum")
+
+
+def drawChSum(hbooked, run, xmin=0, xmax=8000, outdir="plots/ChSum", extraToDraws=[]):
+    h = hbooked.GetValue()
 
     h.SetLineColor(ROOT.kBlack)
     h.SetMarkerColor(ROOT.kBlack)
@@ -23,26 +141,16 @@ def plotChSum(t, run, xmin=0, xmax=8000, outdir="plots/ChSum", extraToDraws=[]):
                "Counts", outname, dology=True, outdir=outdir, lheader=title, legendPos=(0.25, 0.85, 0.80, 0.90), extraToDraws=extraToDraws)
 
 
+def plotChSum(t, run, xmin=0, xmax=8000, outdir="plots/ChSum", extraToDraws=[]):
+    hbooked = bookChSum(getRunDataFrame(t), run, xmin, xmax)
+    drawChSum(hbooked, run, xmin, xmax, outdir, extraToDraws)
+
+
 def getChannelMap(chan):
-    chanMap = {
-        15: (0, 0),
-        14: (1, 0),
-        13: (0, 1),
-        12: (1, 1),
-        11: (2, 0),
-        10: (3, 0),
-        9: (2, 1),
-        8: (3, 1),
-        7: (0, 2),
-        6: (1, 2),
-        5: (0, 3),
-        4: (1, 3),
-        3: (2, 2),
-        2: (3, 2),
-        1: (2, 3),
-        0: (3, 3)
-    }
-    return chanMap[chan]
+    """
+    (x, y) of the channel, from the precomputed geometry tables
+    """
+    return geometry["chan_xy"][chan]
 
 
 def plotChMap(outdir="plots/ChMap"):
@@ -58,39 +166,27 @@ def plotChMap(outdir="plots/ChMap"):
                "ChMap", dology=False, drawoptions="text", dologz=False, legendPos=(0.30, 0.87, 0.70, 0.97), lheader="Channel Map", outdir=outdir, zmin=0.0, zmax=15.0, textformat=".0f")
 
 
-def plotCh2D(t, run, plotAvg=True, applySel=True, outdir="plots/Ch2D", xmin=None, xmax=None):
-    # use RDF such that the loop is only needed once
-    rdf = ROOT.RDataFrame(t)
-
-    energy = GetEnergy(run)
-
+def bookCh2D(rdf, run, applySel=True, xmin=None, xmax=None):
     if applySel:
-        _, atte, hasfilter, _ = runinfo[run]
-        _, _, fitmin, fitmax = GetFitRange(energy, atte, hasfilter)
-        if xmin is not None:
-            fitmin = xmin
-        if xmax is not None:
-            fitmax = xmax
-        # fitmin and fitmax are basically the electron dominated region
-        rdf = rdf.Define("ADCSum", "Sum(ch_lg)").Filter(
-            f"ADCSum > {fitmin}").Filter(f'ADCSum < {fitmax}')
-
-    nEvents = rdf.Count().GetValue()
-
-    histos = OrderedDict()
-    for ch in range(16):
-        x, y = getChannelMap(ch)
-        rdf = rdf.Define(f"x_{ch}", str(x)).Define(f"y_{ch}", str(
-            y)).Define(f"count_{run}_{ch}", f"ch_lg[{ch}]")
+        rdf = applyFitRangeSel(rdf, run, xmin, xmax)
+
+    # sum of ch_lg per channel in one histogram, mapped to the 4x4 grid when drawing
+    rdf = rdf.Define("chIndex", "emcalChannelIndex(ch_lg)")
+    return {
+        "count": rdf.Count(),
+        "chsum": rdf.Histo1D((f"h_ChSums_{run}", "h", 16, -0.5, 15.5), "chIndex", "ch_lg"),
+    }
 
-        histos[ch] = rdf.Histo2D(
-            (f"h_Chs_{run}_{ch}", "h", 4, -0.5, 3.5, 4, -0.5, 3.5), f"x_{ch}", f"y_{ch}", f"count_{run}_{ch}")
 
+def drawCh2D(booked, run, plotAvg=True, outdir="plots/Ch2D"):
+    hsum = booked["chsum"].GetValue()
     h2D = ROOT.TH2F(f"h_Chs_{run}", "h", 4, -0.5, 3.5, 4, -0.5, 3.5)
     for ch in range(16):
-        h2D.Add(histos[ch].GetValue())
+        x, y = getChannelMap(ch)
+        h2D.SetBinContent(x+1, y+1, hsum.GetBinContent(ch+1))
 
     if plotAvg:
+        nEvents = booked["count"].GetValue()
         h2D.Scale(1.0 / (nEvents+0.001))
 
     title = GetTitle(run)
@@ -99,30 +195,37 @@ def plotCh2D(t, run, plotAvg=True, applySel=True, outdir="plots/Ch2D", xmin=None
                f"Run{run}_ch_lg_2D", dology=False, drawoptions="colz,text", dologz=True, legendPos=(0.15, 0.87, 0.80, 0.97), lheader=title, outdir=outdir, zmin=1.0, zmax=2e3)
 
 
-def plotCh1D(t, run, plotAvg=True, applySel=False, makePlots=True, xmin=0, xmax=1000, xbins=100):
-    rdf = ROOT.RDataFrame(t)
+def plotCh2D(t, run, plotAvg=True, applySel=True, outdir="plots/Ch2D", xmin=None, xmax=None):
+    booked = bookCh2D(getRunDataFrame(t), run, applySel, xmin, xmax)
+    drawCh2D(booked, run, plotAvg, outdir)
 
-    energy = GetEnergy(run)
 
+def bookCh1D(rdf, run, applySel=False, xmin=0, xmax=1000, xbins=100):
     if applySel:
-        _, atte, hasfilter, _ = runinfo[run]
-        _, _, fitmin, fitmax = GetFitRange(energy, atte, hasfilter)
-        rdf = rdf.Define("ADCSum", "Sum(ch_lg)").Filter(
-            f"ADCSum > {fitmin}").Filter(f'ADCSum < {fitmax}')
+        rdf = applyFitRangeSel(rdf, run)
 
-    nEvents = rdf.Count().GetValue()
-
-    histos_hg = OrderedDict()
-    histos_lg = OrderedDict()
+    booked = {"count": rdf.Count(), "hg": OrderedDict(), "lg": OrderedDict()}
     for ch in range(16):
         rdf = rdf.Define(f"ch_hg_{ch}", f"ch_hg[{ch}]").Define(
             f"ch_lg_{ch}", f"ch_lg[{ch}]")
-        histos_hg[ch] = rdf.Histo1D(
+        booked["hg"][ch] = rdf.Histo1D(
             (f"h_Chs_hg_{run}_{ch}", "h", xbins, xmin, xmax), f"ch_hg_{ch}")
-        histos_lg[ch] = rdf.Histo1D(
+        booked["lg"][ch] = rdf.Histo1D(
             (f"h_Chs_lg_{run}_{ch}", "h", xbins, xmin, xmax), f"ch_lg_{ch}")
+    return booked
+
+
+def drawCh1D(booked, run, plotAvg=True, makePlots=True, xmin=0, xmax=1000):
+    histos_hg = OrderedDict()
+    histos_lg = OrderedDict()
+    for ch in range(16):
+        histos_hg[ch] = booked["hg"][ch].GetValue()
+        histos_hg[ch].SetDirectory(0)
+        histos_lg[ch] = booked["lg"][ch].GetValue()
+        histos_lg[ch].SetDirectory(0)
 
     if plotAvg:
+        nEvents = booked["count"].GetValue()
         for ch in range(16):
             histos_hg[ch].Scale(1.0 / (nEvents+0.001))
             histos_lg[ch].Scale(1.0 / (nEvents+0.001))
@@ -138,20 +241,19 @@ def plotCh1D(t, run, plotAvg=True, applySel=False, makePlots=True, xmin=0, xmax=
 
         mycolors = [15 + i*5 for i in range(16)]
 
-        DrawHistos([histos_hg[ch].GetValue() for ch in range(16)], [f"Ch {ch}" for ch in range(16)], xmin, xmax, "High Gain ADC", 1e-6, 1e3, "Counts",
+        DrawHistos([histos_hg[ch] for ch in range(16)], [f"Ch {ch}" for ch in range(16)], xmin, xmax, "High Gain ADC", 1e-6, 1e3, "Counts",
                    f"Run{run}_ch_hg_1D", dology=True, outdir="plots/Ch1D/hg", legendPos=(0.35, 0.70, 0.90, 0.90), mycolors=mycolors, extraToDraws=[ltitle], legendNCols=4, addOverflow=True)
-        DrawHistos([histos_lg[ch].GetValue() for ch in range(16)], [f"Ch {ch}" for ch in range(16)], xmin, xmax, "Low Gain ADC", 1e-6, 1e3, "Counts",
+        DrawHistos([histos_lg[ch] for ch in range(16)], [f"Ch {ch}" for ch in range(16)], xmin, xmax, "Low Gain ADC", 1e-6, 1e3, "Counts",
                    f"Run{run}_ch_lg_1D", dology=True, outdir="plots/Ch1D/lg", legendPos=(0.35, 0.70, 0.90, 0.90), mycolors=mycolors, extraToDraws=[ltitle], legendNCols=4, addOverflow=True)
 
-    for ch in range(16):
-        histos_hg[ch] = histos_hg[ch].GetValue()
-        histos_hg[ch].SetDirectory(0)
-        histos_lg[ch] = histos_lg[ch].GetValue()
-        histos_lg[ch].SetDirectory(0)
-
     return histos_hg, histos_lg
 
 
+def plotCh1D(t, run, plotAvg=True, applySel=False, makePlots=True, xmin=0, xmax=1000, xbins=100):
+    booked = bookCh1D(getRunDataFrame(t), run, applySel, xmin, xmax, xbins)
+    return drawCh1D(booked, run, plotAvg, makePlots, xmin, xmax)
+
+
 def plotWeight(run):
     """
     plot the weights from the regression.
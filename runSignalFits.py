@@ -1,18 +1,205 @@
 import ROOT
-import sys
 import os
-import numpy as np
 import json
+from multiprocessing import Pool
+from modules import fitFunction, binnedFit
+from modules.manifest import isUpToDate, recordManifest, parseForce
 
 ROOT.gROOT.SetBatch(True)
 
+# source files of this stage, for the manifests
+code = [__file__, fitFunction.__file__, binnedFit.__file__]
+
+
+def getOutput(run):
+    return f"results/signalfits/Run{run}.json"
+
+
+def getRebin(energy, kind, hasAtten, hasFilter):
+    """
+    rebinning of the calibrated energy histogram of kind mip, linear or unc
+    """
+    rebin = 1
+    if energy == 8.0:
+        rebin = 2
+    elif kind == "mip" and energy >= 12.0 and energy < 20.0:
+        rebin = 4
+    elif kind != "mip" and energy == 12.0:
+        rebin = 4
+    elif energy >= 20.0:
+        rebin = 5
+    if kind == "mip" and not hasAtten and not hasFilter:
+        rebin *= 2
+    return rebin
+
+
+def getFitJobs(run, force=False, backend="roofit"):
+    """
+    check the run and return (cached result, None) if its fits are up to date,
+    (None, fit jobs) if they need to be run, and (None, None) if the run can not be fitted.
+    Each fit job is one histogram of the run
+    """
+    from modules.runinfo import runinfo, GetFitRange, IsMuonRun
+
+    fname = f"calibrated/Run{run}_list.root"
+
+    if not os.path.exists(fname):
+        print(f"File {fname} does not exist")
+        return None, None
+
+    if run not in runinfo:
+        print(f"Run {run} not in run info")
+        return None, None
+
+    if IsMuonRun(run):
+        print(f"Run {run} is a muon run")
+        return None, None
+
+    be, hasAtten, hasFilter, _ = runinfo[run]
+    energy = be * 8.0
+    print(f"Run {run} has energy {energy} GeV")
+    print(f"attenuation {hasAtten}, neural density filter {hasFilter}")
+    fitranges = GetFitRange(int(energy), hasAtten, hasFilter)
+    if fitranges is None:
+        print(f"Fit range not found for run {run}")
+        return None, None
+    print(f"Fit ranges: {fitranges}")
+
+    # skip the fits if the calibrated file has not changed
+    output = getOutput(run)
+    params = {"fitranges": fitranges, "backend": backend}
+    if not force and isUpToDate(output, [fname], params, code):
+        print(f"Run {run} is up to date, reading the fit results from {output}")
+        with open(output, "r") as f:
+            return json.load(f), None
+
+    fitargs = {"xmin": fitranges[0], "xmax": fitranges[1],
+               "xfitmin": fitranges[2], "xfitmax": fitranges[3], "backend": backend}
+    jobs = [
+        {"run": run, "kind": "mip", "hname": "hcal_mip", "suffix": f"cal_{run}",
+         "fitargs": dict(fitargs, outdir="plots/MIPCalibed/Fits/")},
+        {"run": run, "kind": "linear", "hname": "hcal_linear", "suffix": f"linear_{run}",
+         "fitargs": dict(fitargs, outdir="plots/LinearRegressed/Fits/")},
+        {"run": run, "kind": "unc", "hname": "hcal_unc", "suffix": f"uncal_{run}",
+         "fitargs": dict(fitargs, be=be, hasAtten=hasAtten)},
+    ]
+    for job in jobs:
+        job["fname"] = fname
+        job["energy"] = energy
+        job["params"] = params
+        job["rebin"] = getRebin(energy, job["kind"], hasAtten, hasFilter)
+    return None, jobs
+
+
+def fitJob(job):
+    """
+    fit one histogram, returns (mu, muE, sigma, sigmaE), None if the histogram is missing
+    """
+    from modules.fitFunction import runFit
+
+    f = ROOT.TFile(job["fname"])
+    h = f.Get(job["hname"])
+    if not h:
+        f.Close()
+        return None
+    if job["rebin"] > 1:
+        h.Rebin(job["rebin"])
+    (mu, muE), (sigma, sigmaE) = runFit(h, job["suffix"], **job["fitargs"])
+    f.Close()
+    return mu, muE, sigma, sigmaE
+
+
+def collectResult(run, jobs, fits):
+    """
+    result of a run from its fit jobs, saved with its manifest
+    """
+    fits = {job["kind"]: fit for job, fit in zip(jobs, fits)}
+    mu, muE, sigma, sigmaE = fits["mip"]
+    result = {
+        "run": run,
+        "energy": jobs[0]["energy"],
+        "mu": mu,
+        "muE": muE,
+        "sigma": sigma / mu,
+        "sigmaE": sigmaE / mu,
+    }
+    if fits["linear"] is not None:
+        mu_linear, muE_linear, sigma_linear, sigmaE_linear = fits["linear"]
+        result.update({
+            "mu_linear": mu_linear,
+            "muE_linear": muE_linear,
+            "sigma_linear": sigma_linear / mu_linear,
+            "sigmaE_linear": sigmaE_linear / mu_linear,
+        })
+    else:
+        print(f"Run {run} has no linear regression histogram")
+        result.update({"mu_linear": None, "muE_linear": None,
+                      "sigma_linear": None, "sigmaE_linear": None})
+
+    output = getOutput(run)
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as fout:
+        json.dump(result, fout)
+    recordManifest(output, [jobs[0]["fname"]], jobs[0]["params"], code)
+    return result
+
+
+def fitRuns(runs, force=False, njobs=4, backend="roofit"):
+    """
+    fit the calibrated energy histograms of the runs, with the fits of all the runs
+    and histograms dispatched to a pool of njobs processes.
+    The results are reused for the runs whose calibrated file has not changed, unless force is True.
+    backend is the fit backend of runFit, roofit or numpy.
+    Returns the results of the runs that could be fitted, in the order of runs
+    """
+    results = {}
+    jobs = {}
+    for run in runs:
+        cached, runjobs = getFitJobs(run, force, backend)
+        if cached is not None:
+            results[run] = cached
+        elif runjobs is not None:
+            jobs[run] = runjobs
+
+    alljobs = [job for runjobs in jobs.values() for job in runjobs]
+    if njobs > 1 and len(alljobs) > 1:
+        with Pool(njobs) as p:
+            allfits = p.map(fitJob, alljobs, chunksize=1)
+    else:
+        allfits = [fitJob(job) for job in alljobs]
+
+    ifit = 0
+    for run, runjobs in jobs.items():
+        fits = allfits[ifit:ifit+len(runjobs)]
+        ifit += len(runjobs)
+        if fits[0] is None:
+            print(f"Run {run} has no hcal_mip histogram")
+            continue
+        results[run] = collectResult(run, runjobs, fits)
+
+    return [results[run] for run in runs if run in results]
+
+
+def fitRun(run, force=False):
+    """
+    fit the calibrated energy histograms of one run.
+    returns None if the run can not be fitted
+    """
+    results = fitRuns([run], force, njobs=1)
+    return results[0] if len(results) > 0 else None
+
 
 if __name__ == "__main__":
     from modules.utils import parseRuns
+    import argparse
     run_start, run_end = parseRuns()
-
-    from modules.runinfo import runinfo, GetFitRange, IsMuonRun
-    from modules.fitFunction import runFit, runMIPFit
+    force = parseForce()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-j", "--jobs", type=int, default=4,
+                        help="number of fits run in parallel")
+    parser.add_argument("--backend", type=str, default="roofit", choices=["roofit", "numpy"],
+                        help="fit backend of the gaussian fits")
+    args, unknown = parser.parse_known_args()
 
     runs = []
     energys = []
@@ -25,84 +212,18 @@ if __name__ == "__main__":
     sigmas_linear = []
     sigmaEs_linear = []
 
-    for run in range(run_start, run_end+1):
-        fname = f"calibrated/Run{run}_list.root"
-
-        if not os.path.exists(fname):
-            print(f"File {fname} does not exist")
-            continue
-
-        if run not in runinfo:
-            print(f"Run {run} not in run info")
-            continue
-
-        if IsMuonRun(run):
-            print(f"Run {run} is a muon run")
-            continue
-
-        be, hasAtten, hasFilter, _ = runinfo[run]
-        energy = be * 8.0
-        print(f"Run {run} has energy {energy} GeV")
-        print(f"attenuation {hasAtten}, neural density filter {hasFilter}")
-        fitranges = GetFitRange(int(energy), hasAtten, hasFilter)
-        if fitranges is None:
-            print(f"Fit range not found for run {run}")
-            continue
-        print(f"Fit ranges: {fitranges}")
-
-        f = ROOT.TFile(fname)
-        hcal = f.Get("hcal_mip")
-        hcal_linear = f.Get("hcal_linear")
-        hcal_unc = f.Get("hcal_unc")
-
-        if energy == 8.0:
-            hcal.Rebin(2)
-        elif energy >= 12.0 and energy < 20.0:
-            hcal.Rebin(4)
-        elif energy >= 20.0:
-            hcal.Rebin(5)
-
-        if not hasAtten and not hasFilter:
-            hcal.Rebin(2)
-
-        (mu, muE), (sigma, sigmaE) = runFit(hcal, f"cal_{run}", xmin=fitranges[0], xmax=fitranges[1],
-                                            xfitmin=fitranges[2], xfitmax=fitranges[3], outdir="plots/MIPCalibed/Fits/")
-
-        # (mu, muE), (sigma, sigmaE) = runMIPFit(hcal, f"cal_{run}", xmin=fitranges[0], xmax=fitranges[1],
-        #                                       xfitmin=fitranges[2], xfitmax=fitranges[3], outdir="plots/MIPCalibed/MIPFits/")
-
-        if hcal_linear:
-            if energy == 8.0:
-                hcal_linear.Rebin(2)
-            elif energy == 12.0:
-                hcal_linear.Rebin(4)
-            elif energy >= 20.0:
-                hcal_linear.Rebin(5)
-            fit_ranges = GetFitRange(
-                int(energy), hasAtten, hasFilter, isLinearRegression=True)
-            (mu_linear, muE_linear), (sigma_linear, sigmaE_linear) = runFit(hcal_linear, f"linear_{run}",
-                                                                            xmin=fitranges[0], xmax=fitranges[1], xfitmin=fitranges[2], xfitmax=fitranges[3], outdir="plots/LinearRegressed/Fits/")
-
-        if hcal_unc:
-            if energy == 8.0:
-                hcal_unc.Rebin(2)
-            elif energy == 12.0:
-                hcal_unc.Rebin(4)
-            elif energy >= 20.0:
-                hcal_unc.Rebin(5)
-            runFit(hcal_unc, f"uncal_{run}", xmin=fitranges[0], xmax=fitranges[1],
-                   xfitmin=fitranges[2], xfitmax=fitranges[3], be=be, hasAtten=hasAtten)
-
+    for result in fitRuns(range(run_start, run_end+1), force, args.jobs, args.backend):
+        run = result["run"]
         runs.append(run)
-        energys.append(energy)
-        mus.append(mu)
-        muEs.append(muE)
-        sigmas.append(sigma / mu)
-        sigmaEs.append(sigmaE / mu)
-        mus_linear.append(mu_linear)
-        muEs_linear.append(muE_linear)
-        sigmas_linear.append(sigma_linear / mu_linear)
-        sigmaEs_linear.append(sigmaE_linear / mu_linear)
+        energys.append(result["energy"])
+        mus.append(result["mu"])
+        muEs.append(result["muE"])
+        sigmas.append(result["sigma"])
+        sigmaEs.append(result["sigmaE"])
+        mus_linear.append(result["mu_linear"])
+        muEs_linear.append(result["muE_linear"])
+        sigmas_linear.append(result["sigma_linear"])
+        sigmaEs_linear.append(result["sigmaE_linear"])
 
     fitresults = {
         "runs": runs,
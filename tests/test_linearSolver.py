@@ -0,0 +1,48 @@
+import numpy as np
+from modules.linearSolver import solveL1IRLS, solveL1IRLSStream, solveL1Minimize
+
+
+def makeEvents(nevents=5000, target=2000.0, seed=1):
+    rng = np.random.default_rng(seed)
+    scales = rng.uniform(0.8, 1.2, 16)
+    chans = rng.gamma(2.0, 50.0, (nevents, 16))
+    chans *= (target / (chans @ scales) * rng.normal(1.0, 0.03, nevents))[:, None]
+    return chans, target
+
+
+def test_irls_converges_to_l1_minimum():
+    chans, target = makeEvents()
+    result = solveL1IRLS(chans, target)
+    assert result.success
+    assert result.message == "converged"
+    reference = solveL1Minimize(chans, target)
+    assert result.fun <= reference.fun * (1 + 1e-4)
+
+
+def test_irls_stops_when_objective_increases():
+    chans, target = makeEvents()
+    x0 = np.append(np.ones(16), 1.0)
+    rng = np.random.default_rng(2)
+    noisy = chans * rng.uniform(0.0, 3.0, chans.shape)
+    npasses = []
+
+    def chunks():
+        # the events change after the first pass, such that the objective goes up
+        npasses.append(1)
+        return iter([chans if len(npasses) == 1 else noisy])
+
+    fun0 = np.abs(chans @ x0[:-1] - target).sum()
+    result = solveL1IRLSStream(chunks, target, x0=x0)
+    assert not result.success
+    assert "increased" in result.message
+    assert result.nit == 2
+    # the best iterate is the starting point, with its objective
+    np.testing.assert_allclose(result.x, x0)
+    assert np.isclose(result.fun, fun0)
+
+
+def test_irls_maxiter_is_not_success():
+    chans, target = makeEvents()
+    result = solveL1IRLS(chans, target, maxiter=2)
+    assert not result.success
+    assert result.message == "maximum number of iterations reached"
@@ -0,0 +1,63 @@
+# compare the numpy and roofit backends of the gaussian fits
+# on the calibrated energy histograms of the runs
+import ROOT
+import time
+import numpy as np
+from modules.fitFunction import runFitOnly
+from runSignalFits import getFitJobs
+
+ROOT.gROOT.SetBatch(True)
+
+
+def compareBackends(runs):
+    """
+    fit each histogram of the runs with both backends,
+    print the differences and return them as a list of dicts
+    """
+    comparisons = []
+    times = {"roofit": 0.0, "numpy": 0.0}
+    for run in runs:
+        _, jobs = getFitJobs(run, force=True)
+        if jobs is None:
+            continue
+        for job in jobs:
+            f = ROOT.TFile(job["fname"])
+            h = f.Get(job["hname"])
+            if not h:
+                f.Close()
+                continue
+            if job["rebin"] > 1:
+                h.Rebin(job["rebin"])
+            fitargs = {key: job["fitargs"][key]
+                       for key in ["xmin", "xmax", "xfitmin", "xfitmax"]}
+            results = {}
+            for backend in ["roofit", "numpy"]:
+                start = time.time()
+                results[backend] = runFitOnly(
+                    h, job["suffix"], "gaus", backend=backend, **fitargs)
+                times[backend] += time.time() - start
+            f.Close()
+
+            comparison = {"run": run, "hname": job["hname"]}
+            for par in ["mean", "sigma"]:
+                ref, new = results["roofit"], results["numpy"]
+                comparison[par] = (new["values"][par] - ref["values"][par]) / ref["errors"][par]
+                comparison[par + "Err"] = new["errors"][par] / ref["errors"][par] - 1.0
+            comparisons.append(comparison)
+
+    print(f"{'run':>5} {'histogram':>12} {'dmean/err':>10} {'dsigma/err':>11} {'meanErr':>8} {'sigmaErr':>9}")
+    for c in comparisons:
+        print(f"{c['run']:>5} {c['hname']:>12} {c['mean']:>10.3f} {c['sigma']:>11.3f} "
+              f"{c['meanErr']:>8.1%} {c['sigmaErr']:>9.1%}")
+    if len(comparisons) > 0:
+        print("max |dmean|/err = {:.3f}, max |dsigma|/err = {:.3f}".format(
+            np.max(np.abs([c["mean"] for c in comparisons])),
+            np.max(np.abs([c["sigma"] for c in comparisons]))))
+    print(f"fit time roofit {times['roofit']:.2f} s, numpy {times['numpy']:.2f} s")
+    return comparisons
+
+
+if __name__ == "__main__":
+    from modules.utils import parseRuns
+    run_start, run_end = parseRuns()
+    compareBackends(range(run_start, run_end+1))